@@ -0,0 +1,296 @@
+import optparse, os, sys, json, time, tempfile, subprocess, shlex, random, io, contextlib, platform, sqlite3, datetime, threading
+import generate_logs, logparser
+
+# ingest throughput of main.py and lookup latency of query.py on synthetic logs (see generate_logs.py),
+# results go to a json file so runs can be compared with --compare
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def bench_env(workDir, dimensions, batchSize):
+    """Environment for main.py/query.py, load_dotenv does not override these"""
+    return {
+        **os.environ,
+        "PATH_TO_ZIP_DIR": os.path.join(workDir, "archives") + "/",
+        "DIRECTORY_TO_EXTRACT_TO": os.path.join(workDir, "files") + "/",
+        "SQLITE3_DB_FILE": os.path.join(workDir, "bench.db"),
+        "SQLITE3_DB_TABLES": json.dumps(dimensions),
+        "PROGRESS_LOG_FILE": os.path.join(workDir, "progress.json"),
+        "BATCH_SIZE": str(batchSize),
+        "LOG_NONE": "1",
+        "LOG_EVERY": "0",
+        "LOG_BATCH": "0",
+        "LOG_FILE": "0",
+        "SHOW_MATCH_BAR": "0",
+        "SHOW_FILE_FOLDER_BAR": "0",
+        "QUERY_CACHE_FILE": "",
+    }
+
+def remove_database(env):
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(env["SQLITE3_DB_FILE"] + suffix):
+            os.remove(env["SQLITE3_DB_FILE"] + suffix)
+
+def bench_ingest(env, args, logStats, fresh=True):
+    """Run main.py with `args` on a fresh (or the existing) database, returns its throughput and peak memory"""
+    if fresh:
+        remove_database(env)
+    with tempfile.TemporaryFile() as errors:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "main.py"), *shlex.split(args)],
+            cwd=os.path.dirname(env["SQLITE3_DB_FILE"]), env=env, stdout=subprocess.DEVNULL, stderr=errors)
+        (_, status, usage) = os.wait4(process.pid, 0) # rusage of this run only
+        seconds = time.perf_counter() - start
+        if os.waitstatus_to_exitcode(status) != 0:
+            errors.seek(0)
+            raise RuntimeError(f"main.py {args} failed:\n{errors.read().decode()[-2000:]}")
+    return {
+        "args": args,
+        "seconds": round(seconds, 3),
+        "rows_per_s": round(logStats["rows"] / seconds),
+        "mb_per_s": round(logStats["bytes"] / 2**20 / seconds, 2),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1), # kB on linux
+    }
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    def at(p):
+        return round(latencies[min(len(latencies)-1, int(len(latencies) * p))] * 1000, 3)
+    return {"samples":len(latencies), "p50_ms":at(0.5), "p99_ms":at(0.99), "max_ms":at(1)}
+
+def timed(function, *args):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(*args)
+    return time.perf_counter() - start
+
+def bench_queries(env, samples, radius, seed):
+    """Latency of query.py lookups, player info and overview against the database of the last ingest"""
+    os.environ.update(env)
+    sys.path.insert(0, REPO_DIR)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import query
+    rng = random.Random(seed)
+    (source, rowid) = query.database.read_source(query.cursor, query.SQLITE3_DB_TABLES[0])
+    query.cursor.execute(f"SELECT x, y, z FROM {source} ORDER BY random() LIMIT {samples}")
+    positions = query.cursor.fetchall()
+    query.cursor.execute(f"SELECT DISTINCT lower_username FROM ({query.player_counts_source()})")
+    players = [row[0] for row in query.cursor.fetchall()]
+
+    def lookup(queryInput):
+        query.resultCache.clear() # every lookup pays for its results, like a fresh query.py process without QUERY_CACHE_FILE
+        query.lookup(queryInput)
+
+    results = {}
+    results["lookup"] = percentiles([timed(lookup, f"{x} {y} {z} range:{radius}") for (x, y, z) in positions])
+    results["lookup_cached"] = percentiles([timed(query.lookup, f"{x} {y} {z} range:{radius}") for (x, y, z) in positions[:10] * 10])
+    results["lookup_source"] = percentiles([timed(lookup, f"{x} {y} {z} range:{radius} source:{rng.choice(players)}") for (x, y, z) in positions])
+    results["lookup_large"] = percentiles([timed(lookup, f"{x} {y} {z} range:{radius * 30}") for (x, y, z) in positions[:max(1, samples // 10)]])
+    if query.snapshot.numpy != None: # the same large lookups on the columnar snapshot
+        snapshotDir = os.path.join(os.path.dirname(env["SQLITE3_DB_FILE"]), "snapshot")
+        query.snapshot.export(query.cursor, query.SQLITE3_DB_TABLES, snapshotDir, query.database.read_generation(query.cursor))
+        query.snapshotEngine = query.snapshot.Snapshot(snapshotDir)
+        results["lookup_large_snapshot"] = percentiles([timed(lookup, f"{x} {y} {z} range:{radius * 30}") for (x, y, z) in positions[:max(1, samples // 10)]])
+        query.snapshotEngine = None
+    results["player"] = percentiles([timed(query.player_counts, rng.choice(players)) for _ in range(samples)])
+    # a name with one letter replaced, what the player menu and source: look up when a name is misspelled
+    misspelled = [name[:i] + "q" + name[i+1:] for name in (rng.choice(players) for _ in range(samples)) for i in [rng.randrange(len(name))] if name]
+    results["player_suggest"] = percentiles([timed(query.suggest_players, name) for name in misspelled])
+    results["overview"] = percentiles([timed(query.overview) for _ in range(max(1, samples // 20))])
+    chunk = query.database.HEATMAP_LEVELS["chunk"]
+    results["hotspots"] = percentiles([timed(query.hotspots, query.process_params(""), chunk, 10) for _ in range(max(1, samples // 20))])
+    world = query.process_params(f"world:{query.SQLITE3_DB_TABLES[0]}")
+    results["heatmap"] = percentiles([timed(query.heatmap_grid, world, (x - radius * 100, z - radius * 100, x + radius * 100, z + radius * 100), chunk)
+        for (x, y, z) in positions[:max(1, samples // 10)]])
+    return results
+
+def bench_contention(env, workDir, dimensions, logOptions, readers, radius, seed, pause=0.01):
+    """Lookups from `readers` threads (read-only pool connections of query.py, `pause` seconds apart) while main.py
+    ingests more logs into the database of the last ingest: their latency and failures ("database is locked")
+    and the ingest throughput, with and without the readers"""
+    import query # imported by bench_queries with `env`
+    archives = os.path.join(workDir, "archives_contention")
+    logStats = generate_logs.generate(archives, dimensions, **logOptions, start=datetime.datetime(2025, 6, 1), seed=seed + 1)
+    (source, rowid) = query.database.read_source(query.cursor, query.SQLITE3_DB_TABLES[0])
+    query.cursor.execute(f"SELECT x, y, z FROM {source} ORDER BY random() LIMIT 1000")
+    positions = query.cursor.fetchall()
+    query.readPool.release()
+
+    # the same ingest into a copy of the database without readers
+    baselineEnv = {**env, "PATH_TO_ZIP_DIR": archives + "/", "SQLITE3_DB_FILE": os.path.join(workDir, "contention_baseline.db")}
+    remove_database(baselineEnv)
+    with sqlite3.connect(env["SQLITE3_DB_FILE"]) as source, sqlite3.connect(baselineEnv["SQLITE3_DB_FILE"]) as copy:
+        source.backup(copy)
+    baseline = bench_ingest(baselineEnv, "", logStats, fresh=False)
+
+    done = threading.Event()
+    latencies, failures = [], []
+    def reader(rng):
+        while not done.is_set():
+            (x, y, z) = rng.choice(positions)
+            start = time.perf_counter()
+            try:
+                query.lookup(f"{x} {y} {z} range:{radius}")
+                latencies.append(time.perf_counter() - start)
+            except sqlite3.OperationalError as err:
+                failures.append(str(err))
+            finally:
+                query.readPool.release()
+            time.sleep(pause)
+    threads = [threading.Thread(target=reader, args=(random.Random(seed + i),)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    try:
+        run = bench_ingest({**env, "PATH_TO_ZIP_DIR": archives + "/"}, "", logStats, fresh=False)
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+    return {**run, "readers":readers, "baseline_rows_per_s":baseline["rows_per_s"], "lookups":percentiles(latencies) if latencies else None, "failed_lookups":len(failures),
+        "errors":sorted(set(failures))[:5]}
+
+CHECK_TIMEZONES = ["UTC", "Europe/Amsterdam", "America/New_York", "America/Sao_Paulo", "Australia/Lord_Howe"]
+
+def set_local_timezone(name):
+    if name:
+        os.environ["TZ"] = name
+    else:
+        os.environ.pop("TZ", None)
+    time.tzset()
+
+def transition_days(name, years):
+    """Dates on which the UTC offset of timezone `name` changes"""
+    zone = logparser.zoneinfo.ZoneInfo(name)
+    day = datetime.datetime(years[0], 1, 1)
+    while day.year <= years[-1]:
+        if day.replace(tzinfo=zone).utcoffset() != (day + datetime.timedelta(days=1)).replace(tzinfo=zone).utcoffset():
+            yield day
+        day += datetime.timedelta(days=1)
+
+def check_timestamps(years=(2024, 2026)):
+    """Compare logparser.to_timestamp() with the strptime conversion for every minute around the DST changes of
+    CHECK_TIMEZONES, both as LOG_TIMEZONE and as the local time of the machine. Returns the number of checked times"""
+    oldTimezone = os.environ.get("TZ")
+    checked = 0
+    try:
+        for name in CHECK_TIMEZONES:
+            for local in (False, True):
+                set_local_timezone(name if local else oldTimezone)
+                logparser.set_timezone(None if local else name)
+                for day in transition_days(name, years):
+                    for minute in range(-24 * 60, 2 * 24 * 60):
+                        when = day + datetime.timedelta(minutes=minute)
+                        for second in (0, 30, 59):
+                            date, clock = when.strftime("%m/%d/%y"), when.strftime(f"%H:%M:{second:02}")
+                            if logparser.to_timestamp(date, clock) != logparser.slow_timestamp(date, clock):
+                                raise AssertionError(f"to_timestamp('{date}', '{clock}') is wrong for {"local time " if local else ""}{name}")
+                            checked += 1
+    finally:
+        set_local_timezone(oldTimezone)
+        logparser.set_timezone(None)
+    return checked
+
+def bench_timestamps(rows, seed):
+    """Conversions per second of strptime and of logparser.to_timestamp() on log like (few dates, sorted times) input"""
+    rng = random.Random(seed)
+    times = [(f"01/{day:02}/25", f"{second // 3600:02}:{second // 60 % 60:02}:{second % 60:02}")
+        for day in range(1, 4) for second in sorted(rng.randrange(86400) for _ in range(rows // 3))]
+    results = {"checked": check_timestamps()}
+    for name, function in (("strptime", logparser.slow_timestamp), ("to_timestamp", logparser.to_timestamp)):
+        logparser.hourEpochs.clear()
+        start = time.perf_counter()
+        for date, clock in times:
+            function(date, clock)
+        results[f"{name}_per_s"] = round(len(times) / (time.perf_counter() - start))
+    return results
+
+def compare(old, new):
+    """Print the metrics of two result files side by side"""
+    for oldRun, newRun in zip(old["ingest"], new["ingest"]):
+        print(f"ingest '{newRun["args"]}': {oldRun["rows_per_s"]} -> {newRun["rows_per_s"]} rows/s, {oldRun["peak_rss_mb"]} -> {newRun["peak_rss_mb"]}MB peak")
+    if "timestamps" in old and "timestamps" in new:
+        print(f"to_timestamp: {old["timestamps"]["to_timestamp_per_s"]} -> {new["timestamps"]["to_timestamp_per_s"]} conversions/s")
+    if "contention" in old and "contention" in new:
+        print(f"contention: {old["contention"]["rows_per_s"]} -> {new["contention"]["rows_per_s"]} rows/s, "
+            f"{old["contention"]["failed_lookups"]} -> {new["contention"]["failed_lookups"]} failed lookups")
+    for name, stats in new["queries"].items():
+        if name in old["queries"]:
+            print(f"{name}: p50 {old["queries"][name]["p50_ms"]} -> {stats["p50_ms"]}ms, p99 {old["queries"][name]["p99_ms"]} -> {stats["p99_ms"]}ms")
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option('--days', dest='days', default=2, type="int",
+        help='Days of generated logs (one file per dimension per day)')
+    parser.add_option('--rows', dest='rows', default=20000, type="int",
+        help='Entries per generated log file')
+    parser.add_option('--players', dest='players', default=200, type="int")
+    parser.add_option('--blocks', dest='blocks', default=500, type="int")
+    parser.add_option('--clusters', dest='clusters', default=20, type="int")
+    parser.add_option('--dimensions', dest='dimensions', default='["overworld","the_nether","the_end"]',
+        help='JSON list of dimensions')
+    parser.add_option('--batch-size', dest='batch_size', default=1000, type="int")
+    parser.add_option('--ingest', dest='ingest', action='append',
+        help='main.py arguments to benchmark, can be given multiple times (default: no arguments)')
+    parser.add_option('--samples', dest='samples', default=200, type="int",
+        help='Lookups per query benchmark')
+    parser.add_option('--radius', dest='radius', default=10, type="int",
+        help='range: of the benchmarked lookups')
+    parser.add_option('--timestamp-rows', dest='timestamp_rows', default=300000, type="int",
+        help='Log times converted by the timestamp benchmark')
+    parser.add_option('--skip-queries', dest='skip_queries', action='store_true', default=False)
+    parser.add_option('--contention-readers', dest='contention_readers', default=4, type="int",
+        help='Lookup threads during a second ingest into the same database (0 skips the contention benchmark)')
+    parser.add_option('--workdir', dest='workdir',
+        help='Directory for the generated logs and database (default: a new temporary directory)')
+    parser.add_option('--seed', dest='seed', default=0, type="int")
+    parser.add_option('-o', '--out', dest='out', default='benchmark.json',
+        help='Result file')
+    parser.add_option('--compare', dest='compare',
+        help='Earlier result file to compare with')
+    opts, args = parser.parse_args()
+
+    dimensions = json.loads(opts.dimensions)
+    workDir = os.path.abspath(opts.workdir or tempfile.mkdtemp(prefix="grieflogger-bench-"))
+    os.makedirs(os.path.join(workDir, "files"), exist_ok=True)
+    env = bench_env(workDir, dimensions, opts.batch_size)
+
+    print(f"generating logs in {workDir}")
+    logStats = generate_logs.generate(os.path.join(workDir, "archives"), dimensions, days=opts.days, rowsPerFile=opts.rows,
+        players=opts.players, blocks=opts.blocks, clusters=opts.clusters, seed=opts.seed)
+    print(f"{logStats["rows"]} entries, {logStats["bytes"] / 2**20:.1f}MiB")
+
+    results = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "logs": {**logStats, "days":opts.days, "players":opts.players, "blocks":opts.blocks, "clusters":opts.clusters},
+        "ingest": [],
+        "timestamps": {},
+        "queries": {},
+    }
+    for args in opts.ingest or [""]:
+        run = bench_ingest(env, args, logStats)
+        print(f"main.py {args}: {run["seconds"]}s, {run["rows_per_s"]} rows/s, {run["mb_per_s"]}MB/s, {run["peak_rss_mb"]}MB peak")
+        results["ingest"].append(run)
+
+    results["timestamps"] = bench_timestamps(opts.timestamp_rows, opts.seed)
+    print(f"timestamps: {results["timestamps"]["checked"]} DST edge times match strptime, "
+        f"{results["timestamps"]["strptime_per_s"]} -> {results["timestamps"]["to_timestamp_per_s"]} conversions/s")
+
+    if not opts.skip_queries:
+        results["queries"] = bench_queries(env, opts.samples, opts.radius, opts.seed)
+        for name, stats in results["queries"].items():
+            print(f"{name}: p50 {stats["p50_ms"]}ms, p99 {stats["p99_ms"]}ms")
+        if opts.contention_readers > 0:
+            logOptions = {"days":opts.days, "rowsPerFile":opts.rows, "players":opts.players, "blocks":opts.blocks, "clusters":opts.clusters}
+            results["contention"] = bench_contention(env, workDir, dimensions, logOptions, opts.contention_readers, opts.radius, opts.seed)
+            contention = results["contention"]
+            print(f"contention: main.py {contention["baseline_rows_per_s"]} rows/s alone, {contention["rows_per_s"]} rows/s with {contention["readers"]} readers, "
+                f"lookups p50 {(contention["lookups"] or {}).get("p50_ms")}ms p99 {(contention["lookups"] or {}).get("p99_ms")}ms, {contention["failed_lookups"]} failed")
+
+    with open(opts.out, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"results written to {opts.out}")
+
+    if opts.compare:
+        with open(opts.compare, "r") as file:
+            compare(json.load(file), results)
@@ -6,7 +6,7 @@ source .env;
 echo "Choose which to delete:
 1. Extracted files ($DIRECTORY_TO_EXTRACT_TO)
 2. SQLite3 database file ($SQLITE3_DB_FILE)
-3. Progress tracker ($PROGRESS_LOG_FILE)";
+3. Progress tracker (ingested_files/ingested_archives tables in $SQLITE3_DB_FILE, $PROGRESS_LOG_FILE)";
 
 read selection;
 selection="${selection:-123}";
@@ -17,7 +17,9 @@ if [[ "$selection" == *"1"* ]]; then
 fi;
 if [[ "$selection" == *"2"* ]]; then
     rm "$SQLITE3_DB_FILE";
+    rm -f "$SQLITE3_DB_FILE-wal" "$SQLITE3_DB_FILE-shm"; # WAL mode, a stale WAL would be applied to the next database at this path
 fi;
 if [[ "$selection" == *"3"* ]]; then
-    rm "$PROGRESS_LOG_FILE";
+    [[ -f "$SQLITE3_DB_FILE" ]] && sqlite3 "$SQLITE3_DB_FILE" "DELETE FROM ingested_files; DELETE FROM ingested_archives;";
+    rm -f "$PROGRESS_LOG_FILE" "$PROGRESS_LOG_FILE.imported";
 fi;
\ No newline at end of file
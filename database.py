@@ -0,0 +1,573 @@
+"""Database structures shared between main.py (ingest) and query.py (lookups and migrations)"""
+
+import datetime, sqlite3, threading, queue, os, urllib.parse
+
+def has_table(cursor, name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name=?", (name,))
+    return cursor.fetchone() != None
+
+def begin(cursor):
+    if not cursor.connection.in_transaction:
+        cursor.execute("BEGIN")
+
+# event tables, one per dimension. The compact layout stores ids into the dict_* tables instead of names,
+# the {table}_named view joins the names back so readers see the same columns either way
+EVENT_COLUMNS = "x, y, z, interaction, username, lower_username, UUID, UNIX_time, block"
+
+def create_event_table(cursor, table, compact=False):
+    if compact:
+        create_dictionaries(cursor)
+        cursor.execute(f"""CREATE TABLE if not exists "{table}" (
+            `x` INTEGER NOT NULL, 
+            `y` INTEGER NOT NULL, 
+            `z` INTEGER NOT NULL, 
+            `interaction_id` INTEGER NOT NULL, 
+            `user_id` INTEGER NOT NULL,
+            `UUID` TEXT, 
+            "UNIX_time" INTEGER NOT NULL, 
+            `block_id` INTEGER,
+            UNIQUE(x, y, z, interaction_id, user_id, UNIX_time, block_id))
+            """)
+        cursor.execute(f"""CREATE VIEW if not exists "{named_view(table)}" AS
+            SELECT e.x, e.y, e.z, i.interaction, u.username, u.lower_username, e.UUID, e.UNIX_time, b.block, e.rowid AS row_id
+            FROM "{table}" e
+            JOIN dict_interactions i ON i.id = e.interaction_id
+            JOIN dict_users u ON u.id = e.user_id
+            LEFT JOIN dict_blocks b ON b.id = e.block_id
+            """)
+        return
+    cursor.execute(f"""CREATE TABLE if not exists "{table}" (
+        `x` INTEGER NOT NULL, 
+        `y` INTEGER NOT NULL, 
+        `z` INTEGER NOT NULL, 
+        `interaction` TEXT NOT NULL, 
+        `username` TEXT NOT NULL,
+        `lower_username` TEXT NOT NULL,
+        `UUID` TEXT, 
+        "UNIX_time" INTEGER NOT NULL, 
+        `block` TEXT,
+        UNIQUE(x, y, z, interaction, username, UNIX_time, block))
+        """)
+
+def is_compact(cursor, table):
+    cursor.execute(f'PRAGMA table_info("{table}")')
+    return any(column[1] == "user_id" for column in cursor.fetchall())
+
+def named_view(table):
+    return f"{table}_named"
+
+def read_source(cursor, table):
+    """(FROM clause, rowid expression) to read `table` with named EVENT_COLUMNS"""
+    if is_compact(cursor, table):
+        return (f'"{named_view(table)}"', "row_id")
+    return (f'"{table}"', "rowid")
+
+def create_dictionaries(cursor):
+    cursor.execute("""CREATE TABLE if not exists dict_users (
+        `id` INTEGER PRIMARY KEY,
+        `username` TEXT NOT NULL UNIQUE,
+        `lower_username` TEXT NOT NULL)
+        """)
+    cursor.execute("CREATE INDEX if not exists dict_users_lower ON dict_users (lower_username)")
+    cursor.execute("""CREATE TABLE if not exists dict_blocks (
+        `id` INTEGER PRIMARY KEY,
+        `block` TEXT NOT NULL UNIQUE)
+        """)
+    cursor.execute("""CREATE TABLE if not exists dict_interactions (
+        `id` INTEGER PRIMARY KEY,
+        `interaction` TEXT NOT NULL UNIQUE)
+        """)
+
+class Dictionary:
+    """In memory name -> id cache in front of the dict_* tables, used by the ingest loop"""
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.users = {}
+        self.blocks = {}
+        self.interactions = {}
+
+    def intern(self, cache, table, column, value, extra={}):
+        if value in cache:
+            return cache[value]
+        columns = {column:value, **extra}
+        self.cursor.execute(f"INSERT OR IGNORE INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})", tuple(columns.values()))
+        self.cursor.execute(f"SELECT id FROM {table} WHERE {column}=?", (value,))
+        cache[value] = self.cursor.fetchone()[0]
+        return cache[value]
+
+    def encode(self, row):
+        """Row tuple with names (see logparser) -> row tuple with ids, in compact table column order (without UUID)"""
+        (x, y, z, interaction, username, lower_username, UNIXtime, block) = row
+        return (
+            x, y, z,
+            self.intern(self.interactions, "dict_interactions", "interaction", interaction),
+            self.intern(self.users, "dict_users", "username", username, {"lower_username":lower_username}),
+            UNIXtime,
+            self.intern(self.blocks, "dict_blocks", "block", block),
+        )
+
+# spatial index, an R*Tree over the block position of every row, kept in sync by triggers
+def spatial_index_table(table):
+    return f"{table}_rtree"
+
+def has_spatial_index(cursor, table):
+    return has_table(cursor, spatial_index_table(table))
+
+def create_spatial_index(cursor, table):
+    """Create (or rebuild) the spatial index of `table` and backfill it with the existing rows.
+    Runs in one transaction so a half built index is never visible, the caller commits.
+    Returns the number of indexed rows"""
+    rtree = spatial_index_table(table)
+    begin(cursor)
+    cursor.execute(f'CREATE VIRTUAL TABLE if not exists "{rtree}" USING rtree_i32(id, minX, maxX, minY, maxY, minZ, maxZ)')
+    cursor.execute(f'DELETE FROM "{rtree}"')
+    cursor.execute(f'INSERT INTO "{rtree}" SELECT rowid, x, x, y, y, z, z FROM "{table}"')
+    indexed = cursor.rowcount
+    cursor.execute(f"""CREATE TRIGGER if not exists "{rtree}_insert" AFTER INSERT ON "{table}" BEGIN
+        INSERT INTO "{rtree}" VALUES (new.rowid, new.x, new.x, new.y, new.y, new.z, new.z);
+        END""")
+    cursor.execute(f"""CREATE TRIGGER if not exists "{rtree}_delete" AFTER DELETE ON "{table}" BEGIN
+        DELETE FROM "{rtree}" WHERE id = old.rowid;
+        END""")
+    return indexed
+
+def sphere_box(pos, radius):
+    """((minX, maxX), (minY, maxY), (minZ, maxZ)) around the sphere around pos"""
+    return tuple((int(coordinate) - radius, int(coordinate) + radius) for coordinate in pos)
+
+def box_filter(table, box, rowid="rowid"):
+    """WHERE clause selecting the rows of `table` inside `box` (numbers or bound parameter names) through its spatial index"""
+    ((minX, maxX), (minY, maxY), (minZ, maxZ)) = box
+    return f"""{rowid} IN (SELECT id FROM "{spatial_index_table(table)}"
+        WHERE minX >= {minX} AND maxX <= {maxX}
+        AND minY >= {minY} AND maxY <= {maxY}
+        AND minZ >= {minZ} AND maxZ <= {maxZ})"""
+
+def spatial_filter(table, pos, radius, rowid="rowid"):
+    """WHERE clause selecting the rows of `table` inside the bounding box of the sphere around pos.
+    The box is a superset, the exact distance still has to be checked"""
+    return box_filter(table, sphere_box(pos, radius), rowid)
+
+# secondary indexes for the access paths of query.py besides position
+SECONDARY_INDEXES = {
+    "by_user": "lower_username, interaction, UNIX_time", # player(), source: (+ action:)
+    "by_time": "UNIX_time", # before:/after:, newest first ordering
+    "by_block": "block, UNIX_time", # object:
+}
+COMPACT_SECONDARY_INDEXES = {
+    "by_user": "user_id, interaction_id, UNIX_time",
+    "by_time": "UNIX_time",
+    "by_block": "block_id, UNIX_time",
+}
+
+def secondary_index_name(table, suffix):
+    return f"{table}_{suffix}"
+
+def has_secondary_indexes(cursor, table):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (secondary_index_name(table, "by_user"),))
+    return cursor.fetchone() != None
+
+def create_secondary_indexes(cursor, table):
+    indexes = COMPACT_SECONDARY_INDEXES if is_compact(cursor, table) else SECONDARY_INDEXES
+    for suffix, columns in indexes.items():
+        cursor.execute(f'CREATE INDEX if not exists "{secondary_index_name(table, suffix)}" ON "{table}" ({columns})')
+
+def drop_secondary_indexes(cursor, table):
+    for suffix in SECONDARY_INDEXES:
+        cursor.execute(f'DROP INDEX if exists "{secondary_index_name(table, suffix)}"')
+
+# rollups, entry counts per (dimension, player, interaction) and per (dimension, day) kept up to date by triggers,
+# so they change in the same transaction as the inserts and only count rows that were actually inserted
+def has_trigger(cursor, name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='trigger' AND name=?", (name,))
+    return cursor.fetchone() != None
+
+def has_rollups(cursor, table):
+    return has_trigger(cursor, f"{table}_rollup_insert")
+
+def trigger_names(cursor, table, row):
+    """(lower_username, interaction, username) of the `row` (new/old) of a trigger on `table`, looked up in the
+    dictionaries for compact tables"""
+    if is_compact(cursor, table):
+        return (f"(SELECT lower_username FROM dict_users WHERE id = {row}.user_id)",
+            f"(SELECT interaction FROM dict_interactions WHERE id = {row}.interaction_id)",
+            f"(SELECT username FROM dict_users WHERE id = {row}.user_id)")
+    return (f"{row}.lower_username", f"{row}.interaction", f"{row}.username")
+
+def create_rollups(cursor, table):
+    """Create the rollup tables and triggers for `table` and (re)compute its rollup rows from scratch.
+    Runs in one transaction, the caller commits. Returns the number of rolled up entries"""
+    begin(cursor)
+    cursor.execute("""CREATE TABLE if not exists rollup_players (
+        `dimension` TEXT NOT NULL,
+        `lower_username` TEXT NOT NULL,
+        `interaction` TEXT NOT NULL,
+        `username` TEXT NOT NULL,
+        `entries` INTEGER NOT NULL,
+        PRIMARY KEY (dimension, lower_username, interaction)) WITHOUT ROWID
+        """)
+    cursor.execute("""CREATE TABLE if not exists rollup_days (
+        `dimension` TEXT NOT NULL,
+        `day` INTEGER NOT NULL,
+        `entries` INTEGER NOT NULL,
+        PRIMARY KEY (dimension, day)) WITHOUT ROWID
+        """)
+    cursor.execute("DELETE FROM rollup_players WHERE dimension=?", (table,))
+    cursor.execute("DELETE FROM rollup_days WHERE dimension=?", (table,))
+    (source, rowid) = read_source(cursor, table)
+    cursor.execute(f"""INSERT INTO rollup_players
+        SELECT '{table}', lower_username, interaction, MAX(username), COUNT(*) FROM {source}
+        GROUP BY lower_username, interaction""")
+    cursor.execute(f"""INSERT INTO rollup_days
+        SELECT '{table}', UNIX_time / 86400, COUNT(*) FROM "{table}" GROUP BY UNIX_time / 86400""")
+    cursor.execute("SELECT COALESCE(SUM(entries), 0) FROM rollup_days WHERE dimension=?", (table,))
+    entries = cursor.fetchone()[0]
+    (newLower, newInteraction, newUsername) = trigger_names(cursor, table, "new")
+    (oldLower, oldInteraction, oldUsername) = trigger_names(cursor, table, "old")
+    cursor.execute(f"""CREATE TRIGGER if not exists "{table}_rollup_insert" AFTER INSERT ON "{table}" BEGIN
+        INSERT INTO rollup_players VALUES ('{table}', {newLower}, {newInteraction}, {newUsername}, 1)
+            ON CONFLICT DO UPDATE SET entries = entries + 1;
+        INSERT INTO rollup_days VALUES ('{table}', new.UNIX_time / 86400, 1)
+            ON CONFLICT DO UPDATE SET entries = entries + 1;
+        END""")
+    cursor.execute(f"""CREATE TRIGGER if not exists "{table}_rollup_delete" AFTER DELETE ON "{table}" BEGIN
+        UPDATE rollup_players SET entries = entries - 1
+            WHERE dimension = '{table}' AND lower_username = {oldLower} AND interaction = {oldInteraction};
+        UPDATE rollup_days SET entries = entries - 1
+            WHERE dimension = '{table}' AND day = old.UNIX_time / 86400;
+        END""")
+    return entries
+
+# heatmap, entries per (dimension, tile, UTC day, interaction) with the time of the latest one and the players per
+# (dimension, tile, UTC day), for tiles of two sizes: chunks (16x16 blocks) and regions (32x32 chunks). A tile is
+# (x >> level, z >> level). Kept up to date by triggers like the rollups, deleting entries lowers the counts but not
+# the latest time. Partitions keep their heatmap rows under their own name
+HEATMAP_LEVELS = {"chunk":4, "region":9}
+
+def has_heatmap(cursor, table):
+    return has_trigger(cursor, f"{table}_heatmap_insert")
+
+def create_heatmap(cursor, table):
+    """Create the heatmap tables and triggers for `table` and (re)compute its heatmap rows from scratch.
+    Runs in one transaction, the caller commits. Returns the number of tiles (of every level)"""
+    begin(cursor)
+    # day first, lookups cover a time window
+    cursor.execute("""CREATE TABLE if not exists heatmap_tiles (
+        `dimension` TEXT NOT NULL,
+        `level` INTEGER NOT NULL,
+        `day` INTEGER NOT NULL,
+        `tile_x` INTEGER NOT NULL,
+        `tile_z` INTEGER NOT NULL,
+        `interaction` TEXT NOT NULL,
+        `entries` INTEGER NOT NULL,
+        `last_time` INTEGER NOT NULL,
+        PRIMARY KEY (dimension, level, day, tile_x, tile_z, interaction)) WITHOUT ROWID
+        """)
+    # tile first, the players get counted for a handful of tiles at a time
+    cursor.execute("""CREATE TABLE if not exists heatmap_players (
+        `dimension` TEXT NOT NULL,
+        `level` INTEGER NOT NULL,
+        `tile_x` INTEGER NOT NULL,
+        `tile_z` INTEGER NOT NULL,
+        `day` INTEGER NOT NULL,
+        `lower_username` TEXT NOT NULL,
+        `entries` INTEGER NOT NULL,
+        PRIMARY KEY (dimension, level, tile_x, tile_z, day, lower_username)) WITHOUT ROWID
+        """)
+    cursor.execute("DELETE FROM heatmap_tiles WHERE dimension=?", (table,))
+    cursor.execute("DELETE FROM heatmap_players WHERE dimension=?", (table,))
+    (source, rowid) = read_source(cursor, table)
+    for level in HEATMAP_LEVELS.values():
+        cursor.execute(f"""INSERT INTO heatmap_tiles
+            SELECT '{table}', {level}, UNIX_time / 86400, x >> {level}, z >> {level}, interaction, COUNT(*), MAX(UNIX_time) FROM {source}
+            GROUP BY UNIX_time / 86400, x >> {level}, z >> {level}, interaction""")
+        cursor.execute(f"""INSERT INTO heatmap_players
+            SELECT '{table}', {level}, x >> {level}, z >> {level}, UNIX_time / 86400, lower_username, COUNT(*) FROM {source}
+            GROUP BY x >> {level}, z >> {level}, UNIX_time / 86400, lower_username""")
+    cursor.execute("SELECT COUNT(*) FROM (SELECT DISTINCT level, tile_x, tile_z FROM heatmap_tiles WHERE dimension=?)", (table,))
+    tiles = cursor.fetchone()[0]
+    (newLower, newInteraction, newUsername) = trigger_names(cursor, table, "new")
+    (oldLower, oldInteraction, oldUsername) = trigger_names(cursor, table, "old")
+    cursor.execute(f"""CREATE TRIGGER if not exists "{table}_heatmap_insert" AFTER INSERT ON "{table}" BEGIN
+        {"".join(f"""INSERT INTO heatmap_tiles VALUES ('{table}', {level}, new.UNIX_time / 86400, new.x >> {level}, new.z >> {level}, {newInteraction}, 1, new.UNIX_time)
+            ON CONFLICT DO UPDATE SET entries = entries + 1, last_time = MAX(last_time, excluded.last_time);
+        INSERT INTO heatmap_players VALUES ('{table}', {level}, new.x >> {level}, new.z >> {level}, new.UNIX_time / 86400, {newLower}, 1)
+            ON CONFLICT DO UPDATE SET entries = entries + 1;
+        """ for level in HEATMAP_LEVELS.values())}END""")
+    cursor.execute(f"""CREATE TRIGGER if not exists "{table}_heatmap_delete" AFTER DELETE ON "{table}" BEGIN
+        {"".join(f"""UPDATE heatmap_tiles SET entries = entries - 1
+            WHERE dimension = '{table}' AND level = {level} AND day = old.UNIX_time / 86400 AND tile_x = old.x >> {level} AND tile_z = old.z >> {level} AND interaction = {oldInteraction};
+        UPDATE heatmap_players SET entries = entries - 1
+            WHERE dimension = '{table}' AND level = {level} AND tile_x = old.x >> {level} AND tile_z = old.z >> {level} AND day = old.UNIX_time / 86400 AND lower_username = {oldLower};
+        """ for level in HEATMAP_LEVELS.values())}END""")
+    return tiles
+
+# player index, every distinct player name of the event tables with an FTS5 trigram index over it (player_search) for
+# did-you-mean lookups of names, prefixes use the unique index. Kept up to date by a trigger on every table like the
+# rollups, names are only added: a player whose entries all got deleted stays known. Without FTS5 or its trigram
+# tokenizer (SQLite 3.34) there is only player_names, query.py then matches the names itself
+def has_player_index(cursor, table):
+    return has_trigger(cursor, f"{table}_players_insert")
+
+def has_trigram(cursor):
+    cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+    return cursor.fetchone()[0] == 1 and sqlite3.sqlite_version_info >= (3, 34, 0)
+
+def create_player_index(cursor, table):
+    """Create the player index and the trigger of `table` and add the names of its entries.
+    Runs in one transaction, the caller commits. Returns the number of added names"""
+    begin(cursor)
+    cursor.execute("""CREATE TABLE if not exists player_names (
+        `id` INTEGER PRIMARY KEY,
+        `lower_username` TEXT NOT NULL UNIQUE,
+        `username` TEXT NOT NULL)
+        """)
+    if has_trigram(cursor):
+        if not has_table(cursor, "player_search"):
+            cursor.execute("""CREATE VIRTUAL TABLE player_search USING fts5(lower_username,
+                content='player_names', content_rowid='id', tokenize='trigram')""")
+            cursor.execute("INSERT INTO player_search (player_search) VALUES ('rebuild')")
+        cursor.execute("CREATE VIRTUAL TABLE if not exists player_search_vocab USING fts5vocab(player_search, 'row')") # names per trigram
+        cursor.execute("""CREATE TRIGGER if not exists player_names_insert AFTER INSERT ON player_names BEGIN
+            INSERT INTO player_search (rowid, lower_username) VALUES (new.id, new.lower_username);
+            END""")
+        cursor.execute("""CREATE TRIGGER if not exists player_names_delete AFTER DELETE ON player_names BEGIN
+            INSERT INTO player_search (player_search, rowid, lower_username) VALUES ('delete', old.id, old.lower_username);
+            END""")
+    cursor.execute("SELECT COUNT(*) FROM player_names")
+    names = cursor.fetchone()[0]
+    # the same name as the rollups for every spelling of a player, MAX(username)
+    (source, rowid) = read_source(cursor, table)
+    cursor.execute(f"""INSERT INTO player_names (lower_username, username)
+        SELECT lower_username, MAX(username) FROM {source} WHERE true GROUP BY lower_username
+        ON CONFLICT (lower_username) DO UPDATE SET username = excluded.username WHERE excluded.username > username""")
+    (newLower, newInteraction, newUsername) = trigger_names(cursor, table, "new")
+    cursor.execute(f"""CREATE TRIGGER if not exists "{table}_players_insert" AFTER INSERT ON "{table}" BEGIN
+        INSERT INTO player_names (lower_username, username) VALUES ({newLower}, {newUsername})
+            ON CONFLICT (lower_username) DO UPDATE SET username = excluded.username WHERE excluded.username > username;
+        END""")
+    cursor.execute("SELECT COUNT(*) FROM player_names")
+    return cursor.fetchone()[0] - names
+
+def clear_player_index(cursor):
+    """Forget every name of the player index, create_player_index() adds them again"""
+    if has_table(cursor, "player_names"):
+        begin(cursor)
+        cursor.execute("DELETE FROM player_names")
+
+def migrate_to_compact(cursor, table):
+    """Rewrite `table` into the compact layout, keeping its spatial index, rollups, heatmap, player index and secondary indexes.
+    Runs in one transaction, the caller commits. Returns the number of migrated rows"""
+    if is_compact(cursor, table):
+        return 0
+    begin(cursor)
+    hadSpatialIndex = has_spatial_index(cursor, table)
+    hadRollups = has_rollups(cursor, table)
+    hadHeatmap = has_heatmap(cursor, table)
+    hadPlayerIndex = has_player_index(cursor, table)
+    hadSecondaryIndexes = has_secondary_indexes(cursor, table)
+    create_dictionaries(cursor)
+    cursor.execute(f'INSERT OR IGNORE INTO dict_users (username, lower_username) SELECT DISTINCT username, lower_username FROM "{table}"')
+    cursor.execute(f'INSERT OR IGNORE INTO dict_blocks (block) SELECT DISTINCT block FROM "{table}" WHERE block IS NOT NULL')
+    cursor.execute(f'INSERT OR IGNORE INTO dict_interactions (interaction) SELECT DISTINCT interaction FROM "{table}"')
+
+    # these get recreated on the new table, the names have to be free for that
+    for trigger in [f"{spatial_index_table(table)}_insert", f"{spatial_index_table(table)}_delete", f"{table}_rollup_insert", f"{table}_rollup_delete",
+            f"{table}_heatmap_insert", f"{table}_heatmap_delete", f"{table}_players_insert"]:
+        cursor.execute(f'DROP TRIGGER if exists "{trigger}"')
+    cursor.execute(f'DROP TABLE if exists "{spatial_index_table(table)}"')
+    drop_secondary_indexes(cursor, table)
+    cursor.execute(f'ALTER TABLE "{table}" RENAME TO "{table}_uncompacted"')
+    create_event_table(cursor, table, compact=True)
+    cursor.execute(f"""INSERT INTO "{table}"
+        SELECT e.x, e.y, e.z, i.id, u.id, e.UUID, e.UNIX_time, b.id
+        FROM "{table}_uncompacted" e
+        JOIN dict_interactions i ON i.interaction = e.interaction
+        JOIN dict_users u ON u.username = e.username
+        LEFT JOIN dict_blocks b ON b.block = e.block
+        ORDER BY e.rowid""")
+    migrated = cursor.rowcount
+    cursor.execute(f'DROP TABLE "{table}_uncompacted"')
+
+    if hadSpatialIndex:
+        create_spatial_index(cursor, table)
+    if hadRollups:
+        create_rollups(cursor, table)
+    if hadHeatmap:
+        create_heatmap(cursor, table)
+    if hadPlayerIndex:
+        create_player_index(cursor, table)
+    if has_table(cursor, "ingest_generation"): # every row id changed
+        bump_generation(cursor)
+    if hadSecondaryIndexes:
+        create_secondary_indexes(cursor, table)
+    return migrated
+
+# ingest generation, bumped in every transaction that adds or rewrites entries so caches of query results know when they are stale
+def create_generation(cursor):
+    cursor.execute("CREATE TABLE if not exists ingest_generation (`generation` INTEGER NOT NULL)")
+    cursor.execute("INSERT INTO ingest_generation SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM ingest_generation)")
+
+def bump_generation(cursor):
+    cursor.execute("UPDATE ingest_generation SET generation = generation + 1")
+
+def read_generation(cursor):
+    """Current ingest generation, None for a database without the counter (caching is off then)"""
+    if not has_table(cursor, "ingest_generation"):
+        return None
+    cursor.execute("SELECT generation FROM ingest_generation")
+    return cursor.fetchone()[0]
+
+# time partitions, optional monthly (UTC) tables "{dimension}_p{yyyymm}" next to the dimension table. Each is a complete
+# event table with its own spatial index and rollups (under its own name), the partitions table maps them to their
+# dimension and the UNIX_time range they hold. Query results tell partition rows apart by their row_id, which is
+# (partition number << PARTITION_BITS) | rowid, the dimension table itself is partition number 0
+PARTITION_BITS = 40
+
+def create_partition_registry(cursor):
+    cursor.execute("""CREATE TABLE if not exists partitions (
+        `name` TEXT PRIMARY KEY,
+        `dimension` TEXT NOT NULL,
+        `number` INTEGER NOT NULL,
+        `start` INTEGER NOT NULL,
+        `end` INTEGER NOT NULL)
+        """)
+
+def month_number(unixTime):
+    date = datetime.datetime.fromtimestamp(unixTime, datetime.timezone.utc)
+    return date.year * 12 + date.month - 1
+
+def month_range(number):
+    """UNIX time of the start of month `number` and of the month after it"""
+    def start(number):
+        return datetime.datetime(number // 12, number % 12 + 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+    return (int(start(number)), int(start(number + 1)))
+
+def partition_name(dimension, number):
+    return f"{dimension}_p{number // 12:04}{number % 12 + 1:02}"
+
+def partition_table(dimension, number):
+    return dimension if number == 0 else partition_name(dimension, number)
+
+def create_partition(cursor, dimension, number):
+    """Create the partition of `dimension` for month `number` with the layout and extras of the dimension table.
+    Runs in the current transaction, the caller commits. Returns its name"""
+    name = partition_name(dimension, number)
+    if has_table(cursor, name):
+        return name
+    begin(cursor)
+    create_partition_registry(cursor)
+    create_event_table(cursor, name, compact=is_compact(cursor, dimension))
+    create_spatial_index(cursor, name)
+    create_rollups(cursor, name)
+    create_heatmap(cursor, name)
+    create_player_index(cursor, name)
+    if has_secondary_indexes(cursor, dimension):
+        create_secondary_indexes(cursor, name)
+    (start, end) = month_range(number)
+    cursor.execute("INSERT INTO partitions VALUES (?, ?, ?, ?, ?)", (name, dimension, number, start, end))
+    return name
+
+def partitions(cursor, dimension=None, after=None, before=None):
+    """(name, dimension, number, start, end) of the partitions (of `dimension`) that can hold times within [after, before]"""
+    if not has_table(cursor, "partitions"):
+        return []
+    cursor.execute("""SELECT name, dimension, number, start, end FROM partitions
+        WHERE (:dimension IS NULL OR dimension = :dimension) AND (:after IS NULL OR end > :after) AND (:before IS NULL OR start <= :before)
+        ORDER BY dimension, number""", {"dimension":dimension, "after":after, "before":before})
+    return cursor.fetchall()
+
+def dimension_sources(cursor, dimension, after=None, before=None):
+    """[(table, partition number)] to read for the times within [after, before] of `dimension`"""
+    return [(dimension, 0)] + [(name, number) for (name, _, number, _, _) in partitions(cursor, dimension, after, before)]
+
+def partition_row_id(number, rowid):
+    """SQL expression of the row_id of rows of partition `number`"""
+    return f"(({number} << {PARTITION_BITS}) | {rowid})" if number else rowid
+
+def split_row_id(rowId):
+    """(partition number, rowid) of a query result row_id"""
+    return (rowId >> PARTITION_BITS, rowId & ((1 << PARTITION_BITS) - 1))
+
+def drop_partition(cursor, name):
+    """Drop a whole partition with its spatial index, rollup and heatmap rows, the cheap way to delete old entries.
+    Runs in one transaction, the caller commits. Returns the number of dropped entries"""
+    begin(cursor)
+    cursor.execute(f'SELECT COUNT(*) FROM "{name}"')
+    entries = cursor.fetchone()[0]
+    cursor.execute(f'DROP VIEW if exists "{named_view(name)}"')
+    cursor.execute(f'DROP TABLE "{name}"') # its triggers go with it
+    cursor.execute(f'DROP TABLE if exists "{spatial_index_table(name)}"')
+    if has_table(cursor, "rollup_players"):
+        cursor.execute("DELETE FROM rollup_players WHERE dimension=?", (name,))
+        cursor.execute("DELETE FROM rollup_days WHERE dimension=?", (name,))
+    if has_table(cursor, "heatmap_tiles"):
+        cursor.execute("DELETE FROM heatmap_tiles WHERE dimension=?", (name,))
+        cursor.execute("DELETE FROM heatmap_players WHERE dimension=?", (name,))
+    cursor.execute("DELETE FROM partitions WHERE name=?", (name,))
+    if has_table(cursor, "ingest_generation"):
+        bump_generation(cursor)
+    return entries
+
+# connections. main.py writes in WAL mode so readers keep seeing the last committed state while it ingests,
+# query.py reads through a pool of read-only connections, one per thread
+def configure_writer(cursor, checkpointMiB=64):
+    """WAL with an automatic (passive) checkpoint whenever the WAL grew past `checkpointMiB`. All dimension tables
+    live in this one database and WAL, so a checkpoint or a reader always sees whole transactions of every table"""
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL") # a power loss can drop the last commits but never corrupts in WAL mode
+    cursor.execute("PRAGMA page_size")
+    cursor.execute(f"PRAGMA wal_autocheckpoint={max(1, (checkpointMiB << 20) // cursor.fetchone()[0])}")
+    cursor.execute(f"PRAGMA journal_size_limit={checkpointMiB << 20}") # the WAL file shrinks back after a checkpoint
+
+def checkpoint(cursor, mode="PASSIVE"):
+    """Copy the WAL into the database, TRUNCATE also empties the WAL file but waits for readers (busy timeout).
+    Returns (busy, WAL pages, checkpointed pages), (0, -1, -1) outside of WAL mode"""
+    cursor.execute(f"PRAGMA wal_checkpoint({mode})")
+    return cursor.fetchone()
+
+class ReadPool:
+    """Read-only (mode=ro) connections for lookups. A thread checks one out on its first query and keeps it until
+    release(), at most `size` threads read at once, the others wait for a connection"""
+    def __init__(self, path, size=4, cacheMiB=64, mmapMiB=256):
+        self.uri = f"file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro"
+        self.cacheMiB = cacheMiB
+        self.mmapMiB = mmapMiB
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue() # most recently used first, its pages are the warmest
+        self.local = threading.local()
+
+    def connect(self):
+        conn = sqlite3.connect(self.uri, uri=True, timeout=5, check_same_thread=False)
+        conn.execute(f"PRAGMA cache_size={-self.cacheMiB << 10}") # KiB
+        conn.execute(f"PRAGMA mmap_size={self.mmapMiB << 20}")
+        return conn
+
+    def cursor(self):
+        """The cursor of the connection this thread has checked out"""
+        if getattr(self.local, "cursor", None) == None:
+            self.slots.acquire()
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+            self.local.cursor = conn.cursor()
+        return self.local.cursor
+
+    def release(self):
+        """Return the connection of this thread to the pool"""
+        cursor = getattr(self.local, "cursor", None)
+        if cursor == None:
+            return
+        self.local.cursor = None
+        cursor.close() # ends a half read result, it would hold on to its read snapshot
+        self.idle.put(cursor.connection)
+        self.slots.release()
+
+class PooledCursor:
+    """Stands in for a cursor, every call goes to the cursor of the calling thread in `pool`"""
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self.pool.cursor(), name)
@@ -0,0 +1,107 @@
+import optparse, os, random, tarfile, io, datetime, json, time
+
+# synthetic GriefLogger logs for benchmarking, one log file per dimension per day, one tar archive per `days_per_archive` days
+
+INTERACTIONS = [("p", 40), ("b", 40), ("o", 15), ("r", 3), ("c", 2)]
+VANILLA_BLOCKS = ["stone", "dirt", "grass_block", "cobblestone", "oak_planks", "oak_log", "glass", "sand", "gravel",
+    "chest", "barrel", "furnace", "crafting_table", "torch", "tnt", "obsidian", "netherrack", "end_stone",
+    "iron_ore", "diamond_ore", "redstone_wire", "hopper", "white_wool", "bricks", "stone_bricks"]
+
+def make_players(count, rng):
+    names = set()
+    while len(names) < count:
+        name = rng.choice(["Steve", "Alex", "Notch", "xX_", "Mr", "The", "Builder", "Miner", "Griefer"])
+        name += rng.choice(["", "_", ""]) + str(rng.randint(0, 9999))
+        names.add(name[:16])
+    return sorted(names)
+
+def make_blocks(count):
+    blocks = [f"minecraft:{block}" for block in VANILLA_BLOCKS[:count]]
+    blocks += [f"somemod:block_{i}" for i in range(count - len(blocks))]
+    return blocks
+
+def record(rng, pos, interaction, player, when, block):
+    return f"{pos[0]}#{pos[1]}#{pos[2]}#{interaction}#{player}#{when.strftime("%m/%d/%y %H:%M:%S")}#{block}"
+
+def generate(outDir, dimensions, days=2, rowsPerFile=10000, players=200, blocks=500, clusters=20, spread=32,
+        worldSize=20000, daysPerArchive=1, start=datetime.datetime(2025, 1, 1), seed=0, asArchives=True):
+    """Write synthetic logs to outDir (tar archives, or plain <dimension>/<file> files when asArchives is False).
+    Rows are spread around `clusters` hotspots per dimension with a normal distribution of `spread` blocks,
+    players and blocks are picked with a skewed distribution so a few are very common, like on a real server.
+    Returns {"rows", "bytes", "files"} of the uncompressed logs"""
+    rng = random.Random(seed)
+    playerNames = make_players(players, rng)
+    blockNames = make_blocks(blocks)
+    playerWeights = [1 / (i + 1) for i in range(len(playerNames))]
+    blockWeights = [1 / (i + 1) for i in range(len(blockNames))]
+    interactions, interactionWeights = zip(*INTERACTIONS)
+    centers = {dimension: [(rng.randint(-worldSize, worldSize), rng.randint(0, 255), rng.randint(-worldSize, worldSize)) for _ in range(clusters)] for dimension in dimensions}
+
+    stats = {"rows":0, "bytes":0, "files":0}
+    os.makedirs(outDir, exist_ok=True)
+    archive = None
+    for day in range(days):
+        date = start + datetime.timedelta(days=day)
+        if asArchives and day % daysPerArchive == 0:
+            if archive:
+                archive.close()
+            archive = tarfile.open(os.path.join(outDir, f"{date.strftime("%Y-%m-%d")}.tar.gz"), "w:gz")
+        for dimension in dimensions:
+            seconds = sorted(rng.randrange(86400) for _ in range(rowsPerFile))
+            lines = []
+            for second in seconds:
+                center = rng.choice(centers[dimension])
+                pos = (round(rng.gauss(center[0], spread)), min(319, max(-64, round(rng.gauss(center[1], spread / 4)))), round(rng.gauss(center[2], spread)))
+                lines.append(record(rng, pos,
+                    rng.choices(interactions, interactionWeights)[0],
+                    rng.choices(playerNames, playerWeights)[0],
+                    date + datetime.timedelta(seconds=second),
+                    rng.choices(blockNames, blockWeights)[0]))
+            data = ("[" + ",\n".join(lines) + "]\n").encode()
+            name = f"{dimension}/{date.strftime("%Y-%m-%d")}.log"
+            if asArchives:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = time.time()
+                archive.addfile(info, io.BytesIO(data))
+            else:
+                os.makedirs(os.path.join(outDir, dimension), exist_ok=True)
+                with open(os.path.join(outDir, name), "wb") as f:
+                    f.write(data)
+            stats["rows"] += len(lines)
+            stats["bytes"] += len(data)
+            stats["files"] += 1
+    if archive:
+        archive.close()
+    return stats
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] OUT_DIR")
+    parser.add_option('--dimensions', dest='dimensions',
+        default=os.getenv('SQLITE3_DB_TABLES') or '["overworld","the_nether","the_end"]',
+        help='JSON list of dimensions (default SQLITE3_DB_TABLES)')
+    parser.add_option('--days', dest='days', default=2, type="int",
+        help='Number of days, one log file per dimension per day')
+    parser.add_option('--rows', dest='rows', default=10000, type="int",
+        help='Entries per log file')
+    parser.add_option('--players', dest='players', default=200, type="int",
+        help='Number of distinct players')
+    parser.add_option('--blocks', dest='blocks', default=500, type="int",
+        help='Number of distinct blocks')
+    parser.add_option('--clusters', dest='clusters', default=20, type="int",
+        help='Number of activity hotspots per dimension')
+    parser.add_option('--spread', dest='spread', default=32, type="int",
+        help='Standard deviation (blocks) of the entries around a hotspot')
+    parser.add_option('--days-per-archive', dest='days_per_archive', default=1, type="int",
+        help='Days of logs per tar archive')
+    parser.add_option('--files', dest='files', action='store_true', default=False,
+        help='Write plain <dimension>/<day>.log files instead of tar archives')
+    parser.add_option('--seed', dest='seed', default=0, type="int")
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("OUT_DIR is required")
+
+    stats = generate(args[0], json.loads(opts.dimensions), days=opts.days, rowsPerFile=opts.rows,
+        players=opts.players, blocks=opts.blocks, clusters=opts.clusters, spread=opts.spread,
+        daysPerArchive=opts.days_per_archive, seed=opts.seed, asArchives=not opts.files)
+    print(f"wrote {stats["rows"]} entries in {stats["files"]} files ({stats["bytes"] / 2**20:.1f}MiB) to {args[0]}")
@@ -0,0 +1,107 @@
+import time, json, contextlib, cProfile, pstats, io, datetime
+
+# instrumentation for main.py: wall time and call count per ingest stage, parsed/inserted/ignored rows, skipped files
+# and per file and per dimension throughput, written as json with 'main.py --report out.json'
+
+def throughput(rows, size, seconds):
+    seconds = max(seconds, 1e-9)
+    return {"rows_per_s": round(rows / seconds), "mb_per_s": round(size / 2**20 / seconds, 2)}
+
+class IngestReport:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {} # name: [seconds, calls]
+        self.rows = {"parsed":0, "inserted":0, "ignored":0}
+        self.skipped = {"files":0, "bytes":0, "rows":0} # already ingested with an identical or earlier version of a file
+        self.files = []
+        self.merges = []
+        self.profiler = None
+
+    def add(self, stage, seconds, calls=1):
+        total = self.stages.setdefault(stage, [0.0, 0])
+        total[0] += seconds
+        total[1] += calls
+
+    def seconds(self, *stages):
+        return sum(self.stages[stage][0] for stage in stages if stage in self.stages)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timed(self, name, function):
+        """`function` with its calls added to stage `name`"""
+        def timedFunction(*args):
+            start = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return timedFunction
+
+    def add_skipped(self, size, rows):
+        self.skipped["files"] += 1
+        self.skipped["bytes"] += size
+        self.skipped["rows"] += rows
+
+    def add_file(self, name, dimension, size, rows, inserted, seconds):
+        self.files.append({"name":name, "dimension":dimension, "bytes":size, "rows":rows, "inserted":inserted,
+            "seconds":round(seconds, 4), **throughput(rows, size, seconds)})
+
+    def start_profile(self):
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop_profile(self, path, limit=25):
+        """Dump the cProfile stats to `path` and return the `limit` functions with the most cumulative time"""
+        self.profiler.disable()
+        self.profiler.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(self.profiler, stream=summary).sort_stats("cumulative").print_stats(limit)
+        return summary.getvalue()
+
+    def dimensions(self):
+        dimensions = {}
+        for file in self.files:
+            total = dimensions.setdefault(file["dimension"], {"files":0, "bytes":0, "rows":0, "inserted":0, "seconds":0.0})
+            for key in ("bytes", "rows", "inserted", "seconds"):
+                total[key] += file[key]
+            total["files"] += 1
+        for total in dimensions.values():
+            total["seconds"] = round(total["seconds"], 4)
+            total.update(throughput(total["rows"], total["bytes"], total["seconds"]))
+        return dimensions
+
+    def summary(self):
+        """One line per stage, slowest first"""
+        wall = time.perf_counter() - self.start
+        return "\n".join(f"{name:>14}: {seconds:8.3f}s {seconds / wall:6.1%} ({calls} calls)"
+            for name, (seconds, calls) in sorted(self.stages.items(), key=lambda stage: -stage[1][0]))
+
+    def as_dict(self, **extra):
+        wall = time.perf_counter() - self.start
+        size = sum(file["bytes"] for file in self.files)
+        return {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            **extra,
+            "wall_seconds": round(wall, 4),
+            "rows": self.rows,
+            "skipped": self.skipped,
+            "files": len(self.files),
+            "bytes": size,
+            **throughput(self.rows["parsed"], size, wall),
+            # worker_* stages are summed over all worker processes, so they can add up to more than the wall time
+            "stages": {name: {"seconds":round(seconds, 4), "calls":calls, "share":round(seconds / wall, 4)}
+                for name, (seconds, calls) in sorted(self.stages.items(), key=lambda stage: -stage[1][0])},
+            "dimensions": self.dimensions(),
+            "merges": self.merges,
+            "per_file": self.files,
+        }
+
+    def write(self, path, **extra):
+        with open(path, "w") as file:
+            json.dump(self.as_dict(**extra), file, indent=2)
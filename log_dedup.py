@@ -0,0 +1,89 @@
+import hashlib, tempfile
+
+# file level deduplication for main.py: rotated archives carry the same log file again, or an earlier (shorter) version
+# of a log that kept growing. ingested_files keeps the sha256, size and entry count of every parsed file and the same for
+# its prefix, everything up to its last line (the last entry can be cut off, or close the list, in a version archived
+# while the log was still being written). A file is checked against the ingested files it could repeat before it gets
+# parsed: a file with the same bytes is skipped, a file that starts with the prefix of an earlier version is only parsed after it
+
+READ_SIZE = 1 << 20
+SPOOL_SIZE = 64 << 20 # bytes of the checked prefix kept in memory, more goes to a temporary file
+TAIL_SIZE = 1 << 20 # longest last lines kept to count the entries after the prefix, a file with longer ones has no prefix
+
+class DedupReader:
+    """Binary reader of a log file (a real file or an archive member stream) that hashes every byte of the file once,
+    keeping the hash up to its last two line ends for finish(). The bytes read while checking prefixes are spooled,
+    reading continues with them from where parsing has to start"""
+    def __init__(self, raw):
+        self.raw = raw
+        self.digest = hashlib.sha256()
+        self.size = 0 # bytes read from raw
+        self.lineEnds = [] # (offset after the line end, hash up to there) of the last two line ends
+        self.tail = bytearray() # the bytes after the first of those
+        self.spool = None
+        self.replaying = False
+        self.start = 0 # file offset parsing starts at
+
+    def read_raw(self, size=-1):
+        data = self.raw.read(size)
+        done = 0
+        last = data.rfind(b"\n")
+        if last != -1:
+            before = data.rfind(b"\n", 0, last)
+            for lineEnd in ([before, last] if before != -1 else [last]):
+                self.digest.update(data[done:lineEnd + 1])
+                done = lineEnd + 1
+                self.lineEnds = self.lineEnds[-1:] + [(self.size + done, self.digest.copy())]
+        self.digest.update(data[done:])
+        self.size += len(data)
+        self.tail += data
+        keep = min(self.size - self.lineEnds[0][0] if self.lineEnds else self.size, TAIL_SIZE)
+        del self.tail[:len(self.tail) - keep]
+        return data
+
+    def match_prefix(self, candidates):
+        """The longest (size, hash, rows) of `candidates` whose hash is the hash of the first `size` bytes of the file, None
+        if there is none. Reads (and spools) the file up to the longest candidate"""
+        self.spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        match = None
+        for size in sorted(set(candidate[0] for candidate in candidates)):
+            while self.size < size:
+                data = self.read_raw(min(READ_SIZE, size - self.size))
+                if not data:
+                    break
+                self.spool.write(data)
+            if self.size < size: # the file is shorter than its stat said
+                break
+            prefixHash = self.digest.copy().hexdigest()
+            match = next((candidate for candidate in candidates if candidate[0] == size and candidate[1] == prefixHash), match)
+        return match
+
+    def read(self, size=-1):
+        if self.spool != None and not self.replaying:
+            self.spool.seek(self.start)
+            self.replaying = True
+        if self.replaying:
+            data = self.spool.read(size)
+            if data:
+                return data
+            self.replaying = False
+            self.spool.close()
+            self.spool = None
+        return self.read_raw(size)
+
+    def finish(self):
+        """Read whatever has not been read yet. Returns (sha256 of the file, (size, sha256, last line) of its prefix or None
+        when it has no line end before its last line)"""
+        while self.read_raw(READ_SIZE):
+            pass
+        lineEnds = self.lineEnds
+        if lineEnds and lineEnds[-1][0] == self.size: # the last line is the one before the line end at the end
+            lineEnds = lineEnds[:-1]
+        if not lineEnds or self.size - lineEnds[-1][0] > len(self.tail):
+            return self.digest.hexdigest(), None
+        (size, digest) = lineEnds[-1]
+        return self.digest.hexdigest(), (size, digest.hexdigest(), bytes(self.tail[len(self.tail) - (self.size - size):]))
+
+    def close(self):
+        if self.spool != None:
+            self.spool.close()
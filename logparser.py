@@ -0,0 +1,113 @@
+import re, datetime, time, zoneinfo, codecs, io
+import log_dedup
+
+# GriefLogger entry: x#y#z#interaction#username#mm/dd/yy hh:mm:ss#block
+regexPattern = r'(-?\d+)#(-?\d+)#(-?\d+)#(\w)#([^#]*)#(\d{2}\/\d{2}\/\d{2}) (\d{2}:\d{2}:\d{2})#([^,\]]*)'
+regex = re.compile(regexPattern)
+
+# log times have no timezone, they are read as `timezone` (None: the local time of this machine, like strptime().timestamp())
+timezone = None
+hourEpochs = {} # "mm/dd/yy hh": UNIX time of the start of that hour, None for hours with a UTC offset change
+
+def set_timezone(name):
+    """Read log times as the IANA timezone `name` (empty or None for local time)"""
+    global timezone
+    timezone = zoneinfo.ZoneInfo(name) if name else None
+    hourEpochs.clear()
+
+def slow_timestamp(date, time):
+    return datetime.datetime.strptime(f"{date} {time}", "%m/%d/%y %H:%M:%S").replace(tzinfo=timezone).timestamp()
+
+def hour_epoch(dateHour):
+    start = datetime.datetime.strptime(dateHour, "%m/%d/%y %H").replace(tzinfo=timezone)
+    epoch = start.timestamp()
+    if (start + datetime.timedelta(hours=1)).timestamp() - epoch != 3600: # DST starts or ends in this hour
+        return None
+    return epoch
+
+def to_timestamp(date, time):
+    """UNIX time of a log date ("mm/dd/yy") and time ("hh:mm:ss"), same result as slow_timestamp().
+    A log file only covers a few dates, so the epoch of every hour is worked out once and the minutes and seconds are added to it"""
+    dateHour = f"{date} {time[:2]}"
+    try:
+        epoch = hourEpochs[dateHour]
+    except KeyError:
+        epoch = hourEpochs[dateHour] = hour_epoch(dateHour)
+    if epoch is None:
+        return slow_timestamp(date, time)
+    return epoch + int(time[3:5]) * 60 + int(time[6:8])
+
+def groups_to_row(groups):
+    """Turn the groups of a regex match into a row tuple in table column order (without UUID)"""
+    # x:0 y:1 z:2 interaction:3 username:4 date:5 time:6 block:7
+    return (
+        int(groups[0]),
+        int(groups[1]),
+        int(groups[2]),
+        groups[3],
+        groups[4],
+        groups[4].lower(),
+        to_timestamp(groups[5], groups[6]),
+        groups[7],
+    )
+
+def parse_content(content):
+    """Parse the text of a log file into a list of row tuples"""
+    return [groups_to_row(match.groups()) for match in regex.finditer(content)]
+
+CHUNK_SIZE = 1 << 20 # characters per read of the streaming parser
+MAX_RECORD = 4096 # most characters of an unfinished entry carried over to the next chunk
+
+def iter_groups(read, digest=None, progress=None, chunkSize=CHUNK_SIZE):
+    """Yield the regex groups of every entry in one pass over `read(chunkSize)` calls, so memory does not depend on the file size.
+    An entry that runs up to the end of a chunk may continue in the next one, so the text from its start is carried over.
+    The utf-8 bytes of every chunk go to `digest.update()` and their length to `progress()`"""
+    tail = ""
+    while True:
+        chunk = read(chunkSize)
+        data = chunk.encode("utf-8")
+        if digest:
+            digest.update(data)
+        if progress:
+            progress(len(data))
+        buffer = tail + chunk
+        end = 0
+        for match in regex.finditer(buffer):
+            if chunk and match.end() == len(buffer): # the block name (or the whole entry) might go on in the next chunk
+                end = match.start()
+                break
+            yield match.groups()
+            end = match.end()
+        if not chunk:
+            return
+        tail = buffer[max(end, len(buffer) - MAX_RECORD):]
+
+def complete_groups(text):
+    """Groups of the entries in `text` that are followed by a delimiter, and the number of characters up to the end of the last one.
+    Whatever comes after that may be an entry that is still being written"""
+    groups = []
+    end = 0
+    for match in regex.finditer(text):
+        if match.end() == len(text):
+            break
+        groups.append(match.groups())
+        end = match.end()
+    return groups, end
+
+def count_entries(data):
+    """Number of entries in the utf-8 bytes `data`"""
+    return sum(1 for _ in regex.finditer(data.decode("utf-8", "replace")))
+
+# worker entry points, these only get picklable arguments and return (rows, log_dedup.DedupReader.finish(), seconds per stage)
+def parse_reader(raw):
+    start = time.perf_counter()
+    reader = log_dedup.DedupReader(raw) # binary, no newline translation, the hash is of the bytes of the file
+    rows = [groups_to_row(groups) for groups in iter_groups(codecs.getreader("utf-8")(reader).read)]
+    return rows, reader.finish(), {"worker_parse":time.perf_counter() - start}
+
+def parse_path(path):
+    with open(path, "rb") as f:
+        return parse_reader(f)
+
+def parse_bytes(data):
+    return parse_reader(io.BytesIO(data))
@@ -1,16 +1,20 @@
-import tarfile, os, sqlite3, re, datetime, json
+import tarfile, os, sys, sqlite3, json, codecs, optparse, time, shutil, io, zoneinfo, signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 from tqdm import tqdm
+import logparser, database, ingest_report, log_dedup
 
 # get the current working directory
 current_working_directory = os.getcwd()
-# get terminal size
-width, height = os.get_terminal_size()
+# get terminal size (falls back to 80x24 when there is no terminal)
+width, height = shutil.get_terminal_size()
 
 # settings
 load_dotenv()
 PATH_TO_ZIP_DIR = os.getenv('PATH_TO_ZIP_DIR')
 DIRECTORY_TO_EXTRACT_TO = os.getenv('DIRECTORY_TO_EXTRACT_TO')
+LIVE_LOG_DIR = os.getenv('LIVE_LOG_DIR') # only used by --follow
 SQLITE3_DB_FILE = os.getenv('SQLITE3_DB_FILE')
 try:
     SQLITE3_DB_TABLES = json.loads(os.getenv('SQLITE3_DB_TABLES'))
@@ -30,12 +34,51 @@ LOG_FILE = os.getenv('LOG_FILE').lower() in ("true", "t", "1") and not LOG_NONE
 SHOW_MATCH_BAR = os.getenv('SHOW_MATCH_BAR').lower() in ("true", "t", "1")
 SHOW_FILE_FOLDER_BAR = os.getenv('SHOW_FILE_FOLDER_BAR').lower() in ("true", "t", "1")
 
+COMPACT_SCHEMA = (os.getenv('COMPACT_SCHEMA') or "0").lower() in ("true", "t", "1") # only used for new tables
+PARTITION_MONTHLY = (os.getenv('PARTITION_MONTHLY') or "0").lower() in ("true", "t", "1") # new entries go into monthly partition tables
+try:
+    WAL_CHECKPOINT_MB = int(os.getenv('WAL_CHECKPOINT_MB') or 64)
+except ValueError as e:
+    raise ValueError(f"Invalid integer in WAL_CHECKPOINT_MB environment variable. Error: {e}") from e
+LOG_TIMEZONE = os.getenv('LOG_TIMEZONE') or None # IANA name, unset reads the log times as local time
+try:
+    logparser.set_timezone(LOG_TIMEZONE)
+except (zoneinfo.ZoneInfoNotFoundError, ValueError) as e:
+    raise ValueError(f"Unknown timezone in LOG_TIMEZONE environment variable. Error: {e}") from e
 
-regexPattern = r'(-?\d+)#(-?\d+)#(-?\d+)#(\w)#([^#]*)#(\d{2}\/\d{2}\/\d{2}) (\d{2}:\d{2}:\d{2})#([^,\]]*)'
+
+# command line options
+parser = optparse.OptionParser()
+parser.add_option('-e', '--extract', dest='extract',
+    action='store_true', default=False,
+    help='Extract every archive to DIRECTORY_TO_EXTRACT_TO and parse the extracted files (default is to stream the logs straight out of the archives)')
+parser.add_option('-w', '--workers', dest='workers',
+    default=0, type="int",
+    help='Parse log files in N worker processes, the main process stays the only database writer (default 0, parse in the main process)')
+parser.add_option('-b', '--bulk', dest='bulk',
+    action='store_true', default=False,
+    help='Bulk load: insert into unindexed staging tables with fast (crash unsafe) pragmas, then dedupe into the real tables in one pass per dimension')
+parser.add_option('-f', '--follow', dest='follow',
+    action='store_true', default=False,
+    help='Keep ingesting what gets appended to the live logs in LIVE_LOG_DIR/<dimension>/ until stopped (instead of reading the archives)')
+parser.add_option('--poll', dest='poll',
+    default=0.5, type="float",
+    help='Seconds between checks of the live logs with --follow (default 0.5)')
+parser.add_option('--commit-interval', dest='commit_interval',
+    default=1.0, type="float",
+    help='Most seconds new live log entries wait before they are committed with --follow (default 1)')
+parser.add_option('--report', dest='report',
+    help='Write the time spent per ingest stage, row counts and per file/dimension throughput of this run to a json file')
+parser.add_option('--profile', dest='profile',
+    help='Run under cProfile and dump the stats to this file (view with python -m pstats), the top functions also go in --report')
+opts, args = parser.parse_args()
 
 # assert valid environment variables
 assert os.path.isdir(PATH_TO_ZIP_DIR), "PATH_TO_ZIP_DIR environment variable does not lead to a valid directory"
-assert os.path.isdir(DIRECTORY_TO_EXTRACT_TO), "DIRECTORY_TO_EXTRACT_TO environment variable does not lead to a valid directory"
+assert not opts.extract or os.path.isdir(DIRECTORY_TO_EXTRACT_TO), "DIRECTORY_TO_EXTRACT_TO environment variable does not lead to a valid directory"
+assert opts.workers >= 0, "--workers should not be negative"
+assert not opts.follow or (LIVE_LOG_DIR and os.path.isdir(LIVE_LOG_DIR)), "LIVE_LOG_DIR environment variable does not lead to a valid directory"
+assert not opts.follow or not (opts.extract or opts.bulk or opts.workers), "--follow can not be combined with --extract, --bulk or --workers"
 assert not os.path.isdir(SQLITE3_DB_FILE) and SQLITE3_DB_FILE[-3:] == ".db", "SQLITE3_DB_FILE environment variable is not a valid .db file"
 assert isinstance(SQLITE3_DB_TABLES, list) and all(isinstance(item, str) for item in SQLITE3_DB_TABLES), "SQLITE3_DB_TABLES environment variable should be a list containing strings"
 assert not os.path.isdir(PROGRESS_LOG_FILE) and PROGRESS_LOG_FILE[-5:] == ".json", "PROGRESS_LOG_FILE environment variable is not a valid .json file"
@@ -65,144 +108,620 @@ def viewColors():
     print(f"{bcolors.UNDERLINE}UNDERLINE{bcolors.ENDC}")
 # viewColors()
 
-files_in_dir = [f for f in os.listdir(PATH_TO_ZIP_DIR) if os.path.isfile(os.path.join(PATH_TO_ZIP_DIR, f))]
+files_in_dir = sorted(f for f in os.listdir(PATH_TO_ZIP_DIR) if os.path.isfile(os.path.join(PATH_TO_ZIP_DIR, f))) # oldest first when named by date, so grown logs come after their earlier versions
 
-print(f"""unzipping
-{bcolors.BOLD}from: {bcolors.ENDC}"""+PATH_TO_ZIP_DIR+f"""
-{bcolors.BOLD}to: {bcolors.ENDC}"""+DIRECTORY_TO_EXTRACT_TO)
-for fileName in (pBarFile := tqdm(files_in_dir)):
-    fileStem, fileExtension = os.path.splitext(fileName)
-    path_to_zip_file = PATH_TO_ZIP_DIR + fileName
-    pBarFile.write(f"extracting {fileName}")
+# create SQLite db connection, in WAL mode so query.py lookups keep working during an ingest
+conn = sqlite3.connect(SQLITE3_DB_FILE, timeout=30)
+cursor = conn.cursor()
+database.configure_writer(cursor, WAL_CHECKPOINT_MB)
 
-    with tarfile.open(path_to_zip_file, 'r') as tar:
-        tar.extractall(DIRECTORY_TO_EXTRACT_TO)
-    pBarFile.write("unzipped: " + fileName)
+for table in SQLITE3_DB_TABLES:
+    database.create_event_table(cursor, table, compact=COMPACT_SCHEMA)
+    cursor.execute(f'SELECT 1 FROM "{table}" LIMIT 1')
+    isNew = cursor.fetchone() == None # nothing to backfill
+    if not database.has_spatial_index(cursor, table):
+        if isNew:
+            database.create_spatial_index(cursor, table)
+        else:
+            print(f"{bcolors.WARNING}Table '{table}' has no spatial index, run 'query.py --build-spatial-index' to create it{bcolors.ENDC}")
+    if not database.has_rollups(cursor, table):
+        if isNew:
+            database.create_rollups(cursor, table)
+        else:
+            print(f"{bcolors.WARNING}Table '{table}' has no rollups, run 'query.py --rebuild-rollups' to create them{bcolors.ENDC}")
+    if not database.has_heatmap(cursor, table):
+        if isNew:
+            database.create_heatmap(cursor, table)
+        else:
+            print(f"{bcolors.WARNING}Table '{table}' has no heatmap, run 'query.py --rebuild-heatmap' to create it{bcolors.ENDC}")
+    if not database.has_player_index(cursor, table):
+        if isNew:
+            database.create_player_index(cursor, table)
+        else:
+            print(f"{bcolors.WARNING}Table '{table}' has no player index, run 'query.py --rebuild-players' to create it{bcolors.ENDC}")
+database.create_generation(cursor)
+conn.commit()
 
-       
-print(f"{bcolors.OKBLUE}unzipped all{bcolors.ENDC}")
+# names get interned into ids for tables with the compact layout
+compactTables = {table: database.is_compact(cursor, table) for table in SQLITE3_DB_TABLES} # partitions have the layout of their dimension table
 
-# create SQLite db connection
-conn = sqlite3.connect(SQLITE3_DB_FILE)
-cursor = conn.cursor()
+# monthly partitions, created on the first entry of their month
+if PARTITION_MONTHLY:
+    database.create_partition_registry(cursor)
+    conn.commit()
+partitionTables = {(dimension, number): name for (name, dimension, number, start, end) in database.partitions(cursor)}
+dayMonths = {} # UNIX day: month number, months start at a UTC midnight
 
-for table in SQLITE3_DB_TABLES:
-    cursor.execute(f"""CREATE TABLE if not exists "{table}" (
-        `x` INTEGER NOT NULL, 
-        `y` INTEGER NOT NULL, 
-        `z` INTEGER NOT NULL, 
-        `interaction` TEXT NOT NULL, 
-        `username` TEXT NOT NULL,
-        `lower_username` TEXT NOT NULL,
-        `UUID` TEXT, 
-        "UNIX_time" INTEGER NOT NULL, 
-        `block` TEXT,
-        UNIQUE(x, y, z, interaction, username, UNIX_time, block))
-        """)
+def partition_of(dimension, unixTime):
+    day = int(unixTime // 86400)
+    if day not in dayMonths:
+        dayMonths[day] = database.month_number(day * 86400)
+    number = dayMonths[day]
+    if (dimension, number) not in partitionTables:
+        partitionTables[(dimension, number)] = database.create_partition(cursor, dimension, number)
+    return partitionTables[(dimension, number)]
+
+dictionary = database.Dictionary(conn.cursor())
+
+# bulk loading goes into unindexed staging tables first, these get merged into the real tables at the end of the run
+def staging_table(table):
+    return f"{table}_staging"
+
+if opts.bulk: # readers only see the staged entries after the merge, so they are not locked out
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.execute("PRAGMA cache_size=-524288") # 512MiB
+    for table in SQLITE3_DB_TABLES:
+        cursor.execute(f'CREATE TABLE if not exists "{staging_table(table)}" AS SELECT * FROM "{table}" WHERE 0') # same columns, no constraints
+
+# ingest progress, one row per parsed log file (extracted file path or archive member name) and per archive
+cursor.execute("""CREATE TABLE if not exists ingested_files (
+    `path` TEXT PRIMARY KEY,
+    `size` INTEGER,
+    `mtime` INTEGER,
+    `hash` TEXT,
+    `rows` INTEGER,
+    `ingest_time` INTEGER NOT NULL)
+    """)
+# the same for the file up to its last line, which a later version of a log that kept growing starts with (log_dedup.py)
+cursor.execute("PRAGMA table_info(ingested_files)")
+if "prefix_hash" not in [column[1] for column in cursor.fetchall()]:
+    for column in ("`prefix_size` INTEGER", "`prefix_hash` TEXT", "`prefix_rows` INTEGER"):
+        cursor.execute(f"ALTER TABLE ingested_files ADD COLUMN {column}")
+cursor.execute("CREATE INDEX if not exists ingested_files_size ON ingested_files (size)") # files with the same content have the same size
+cursor.execute("""CREATE TABLE if not exists ingested_archives (
+    `name` TEXT PRIMARY KEY,
+    `size` INTEGER NOT NULL,
+    `mtime` INTEGER NOT NULL,
+    `ingest_time` INTEGER NOT NULL)
+    """)
+conn.commit()
+
+def import_progress_file():
+    """One time import of an old PROGRESS_LOG_FILE into the ingested_files/ingested_archives tables"""
+    if not os.path.isfile(PROGRESS_LOG_FILE):
+        return
+    with open(PROGRESS_LOG_FILE, "r") as file:
+        progress = json.load(file)
+    now = round(time.time())
+    for path in progress.get("files", []):
+        size, mtime = None, None # unknown, these only get skipped by path like before
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            size, mtime = stat.st_size, int(stat.st_mtime)
+        cursor.execute("INSERT OR IGNORE INTO ingested_files (path, size, mtime, ingest_time) VALUES (?, ?, ?, ?)", (path, size, mtime, now))
+    for name, (size, mtime) in progress.get("members", {}).items():
+        cursor.execute("INSERT OR IGNORE INTO ingested_files (path, size, mtime, ingest_time) VALUES (?, ?, ?, ?)", (name, size, mtime, now))
+    for name, (size, mtime) in progress.get("archives", {}).items():
+        cursor.execute("INSERT OR IGNORE INTO ingested_archives VALUES (?, ?, ?, ?)", (name, size, mtime, now))
+    conn.commit()
+    os.rename(PROGRESS_LOG_FILE, PROGRESS_LOG_FILE + ".imported")
+    print(f"{bcolors.OKBLUE}Imported {PROGRESS_LOG_FILE} into the database (renamed to {PROGRESS_LOG_FILE}.imported){bcolors.ENDC}")
+import_progress_file()
+
+def file_ingested(path, size, mtime):
+    cursor.execute("SELECT size, mtime FROM ingested_files WHERE path=?", (path,))
+    row = cursor.fetchone()
+    return row != None and (row[0] == None or (row[0], row[1]) == (size, int(mtime)))
+
+def archive_ingested(name, size, mtime):
+    cursor.execute("SELECT size, mtime FROM ingested_archives WHERE name=?", (name,))
+    return cursor.fetchone() == (size, int(mtime))
+
+report = ingest_report.IngestReport()
+if opts.profile:
+    report.start_profile()
 
 entriesAdded = 0
 batchCount = 0
 
-dimensionData = {
-    "dim":{},
-    "total_files":0,
-}
-for dimension in SQLITE3_DB_TABLES: # calculate total number of files in all dimensions
-    dimensionDir = os.path.join(DIRECTORY_TO_EXTRACT_TO, dimension + "/")
-    try:
-        with open(PROGRESS_LOG_FILE, "r") as file:
-            progress=json.load(file)
-    except:
-        progress = json.loads(os.getenv("EMPTY_PROGRESS_LOG"))
-        with open(PROGRESS_LOG_FILE, "w") as file:
-            file.write(os.getenv("EMPTY_PROGRESS_LOG"))
-    try:
-        logs_in_dir = [f for f in os.listdir(dimensionDir) if os.path.isfile(os.path.join(dimensionDir, f))] 
-        todo_logs_in_dir = [file for file in logs_in_dir if dimensionDir+file not in progress["files"]]
-    except:
-        logs_in_dir = []
-        todo_logs_in_dir = []
-    dimensionData["dim"][dimension] = {}
-    dimensionData["dim"][dimension]["logs_in_dir"] = logs_in_dir
-    dimensionData["dim"][dimension]["todo_logs_in_dir"] = todo_logs_in_dir
-    dimensionData["total_files"] += len(todo_logs_in_dir)
-
-
-pBarMain = tqdm(total=dimensionData["total_files"])
-for i, dimension in enumerate(SQLITE3_DB_TABLES): # actually parse the files
-    dimsDone = str(i+1)
-    dimsTotal = str(len(SQLITE3_DB_TABLES))
-    padZero = len(dimsTotal) - len(dimsDone)
-    dimsDone = padZero*"0" + dimsDone
-    pBarMain.set_description_str(f"{dimsDone}/{dimsTotal} Dimensions")
-    dimensionDir = os.path.join(DIRECTORY_TO_EXTRACT_TO, dimension + "/")
-    
-    logs_in_dir = dimensionData["dim"][dimension]["logs_in_dir"]
-    todo_logs_in_dir = dimensionData["dim"][dimension]["todo_logs_in_dir"]
-    skippedFiles = len(logs_in_dir) - len(todo_logs_in_dir)
-    if skippedFiles > 0:
-        print(f"{bcolors.BOLD + bcolors.WARNING}Skipped {skippedFiles} files, already parsed{bcolors.ENDC}")
+def insert_batch(dimension, batch, commit=True):
+    global entriesAdded, batchCount
+    if compactTables[dimension]:
+        with report.stage("encode"):
+            rows = [dictionary.encode(row) for row in batch]
+        values = "(?, ?, ?, ?, ?, NULL, ?, ?)"
+    else:
+        rows = batch
+        values = "(?, ?, ?, ?, ?, ?, NULL, ?, ?)"
+    if opts.bulk:
+        targets = {staging_table(dimension): rows}
+    elif PARTITION_MONTHLY:
+        targets = {}
+        for row, encoded in zip(batch, rows):
+            targets.setdefault(partition_of(dimension, row[6]), []).append(encoded)
+    else:
+        targets = {dimension: rows}
+    inserted = 0
+    with report.stage("insert"):
+        for table, tableRows in targets.items():
+            cursor.executemany(f'INSERT {"" if opts.bulk else "OR IGNORE "}INTO "{table}" VALUES {values}', tableRows)
+            inserted += cursor.rowcount
+    if inserted > 0 and not opts.bulk:
+        database.bump_generation(cursor) # cached query results are stale once this commits
+    report.rows["inserted"] += inserted # duplicates of bulk loads are only known after merge_staging()
+    report.rows["ignored"] += len(batch) - inserted
+    if commit:
+        with report.stage("commit"):
+            conn.commit()
+    entriesAdded += len(batch)
+    if LOG_BATCH:
+        tqdm.write(f"Executed batch {batchCount} with {len(batch)} queries") # above the progress bars while there are any, follow() has none
+    batchCount+=1
 
+def finish_file(dimension, batch, path, size, mtime, hashes, rowCount, skippedRows=0):
+    """Insert the last batch of a file and mark the file as ingested in the same transaction. `rowCount` entries were parsed,
+    the `skippedRows` before them were ingested with an earlier version of the file. `hashes` is DedupReader.finish()"""
+    if batch:
+        insert_batch(dimension, batch, commit=False)
+    rows = skippedRows + rowCount
+    (contentHash, prefix) = hashes
+    (prefixSize, prefixHash, prefixRows) = (None, None, None)
+    if prefix != None:
+        (prefixSize, prefixHash, lastLine) = prefix
+        prefixRows = rows - logparser.count_entries(lastLine)
+    cursor.execute("""INSERT OR REPLACE INTO ingested_files (path, size, mtime, hash, rows, ingest_time, prefix_size, prefix_hash, prefix_rows)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (path, size, int(mtime), contentHash, rows, round(time.time()), prefixSize, prefixHash, prefixRows))
+    with report.stage("commit"):
+        conn.commit()
+    report.rows["parsed"] += rowCount
+
+def parse_log(f, dimension, size):
+    """Parse an opened GriefLogger log file of `size` bytes in one streaming pass, inserting full batches into the `dimension` table.
+    Returns the last (not yet inserted) batch and the number of parsed entries"""
     batch = []
+    rowCount = 0
+    if SHOW_MATCH_BAR:
+        pBarMatch = tqdm(total=size, unit="B", unit_scale=True, leave=False)
+    loopStart = time.perf_counter()
+    convertSeconds = 0
+    insertSeconds = report.seconds("read", "insert", "commit", "encode")
+    for groups in logparser.iter_groups(report.timed("read", f.read), None, SHOW_MATCH_BAR and pBarMatch.update or None):
+        # x:0 y:1 z:2 interaction:3 username:4 date:5 time:6 block:7
+        convertStart = time.perf_counter()
+        batch.append(logparser.groups_to_row(groups)) # int()s, lower() and strptime
+        convertSeconds += time.perf_counter() - convertStart
+        rowCount += 1
+        if LOG_EVERY:
+            pBarMain.write(f"Added [{groups[5]} {groups[6]}] {groups[4]} '{groups[3]}' {groups[7]} at {groups[0]} {groups[1]} {groups[2]} to batch")
 
-    loopIter = tqdm(todo_logs_in_dir) if SHOW_FILE_FOLDER_BAR  else todo_logs_in_dir
-    for fileName in loopIter:
-        filePath = dimensionDir + fileName
-        if LOG_FILE:
-            pBarMain.write(f"Parsing {filePath}")
-        with open(filePath, "r") as f:
-            content = f.read()
-            totalMatches = len(re.findall(regexPattern, content))
-            matches = re.finditer(regexPattern, content)
-            if SHOW_MATCH_BAR:
-                pBarMatch = tqdm(matches, total=totalMatches, leave=False)
-            for match in (not SHOW_MATCH_BAR and matches or pBarMatch):
-                groups = match.groups() # x:0 y:1 z:2 interaction:3 username:4 date:5 time:6 block:7\n
-                logData = {
-                    'x':        groups[0],
-                    'y':        groups[1],
-                    'z':        groups[2],
-                    'interaction':   groups[3],
-                    'username': groups[4],
-                    'lower_username': groups[4].lower(),
-                    'UNIX':     datetime.datetime.strptime(f"{groups[5]} {groups[6]}","%m/%d/%y %H:%M:%S").timestamp(),
-                    'block':    groups[7],
-                }
-                
-                batch.append(logData)
-                if LOG_EVERY:
-                    pBarMain.write(f"Added [{groups[5]} {groups[6]}] {groups[4]} '{groups[3]}' {groups[7]} at {groups[0]} {groups[1]} {groups[2]} to batch")
-
-                if len(batch) > BATCH_SIZE:
-                    cursor.executemany(f"INSERT OR IGNORE INTO {dimension} VALUES (:x, :y, :z, :interaction, :username, :lower_username, NULL, :UNIX, :block)", batch)
-                    conn.commit()
-                    entriesAdded += len(batch)
-                    if LOG_BATCH:
-                        pBarMain.write(f"Executed batch {batchCount} with {len(batch)} queries")
-                    batchCount+=1
-                    batch = []
-                if SHOW_MATCH_BAR:
-                    pBarMatch.close()
-        
-        if batch:
-            cursor.executemany(f"INSERT OR IGNORE INTO {dimension} VALUES (:x, :y, :z, :interaction, :username, :lower_username, NULL, :UNIX, :block)", batch)
-            conn.commit()
-            entriesAdded += len(batch)
-            if LOG_BATCH:
-                pBarMain.write(f"Executed batch {batchCount} with {len(batch)} queries")
-            batchCount+=1
+        if len(batch) > BATCH_SIZE:
+            insert_batch(dimension, batch)
             batch = []
+    if SHOW_MATCH_BAR:
+        pBarMatch.close()
+    # what is left of the loop after reading, converting and the batches inserted on the way is matching and hashing
+    insertSeconds = report.seconds("read", "insert", "commit", "encode") - insertSeconds
+    report.add("regex", time.perf_counter() - loopStart - convertSeconds - insertSeconds)
+    report.add("convert", convertSeconds, rowCount)
+    return batch, rowCount
 
-        with open(PROGRESS_LOG_FILE, "r") as file:
-            progress=json.load(file)
-        progress["files"].append(filePath)
-        with open(PROGRESS_LOG_FILE, "w") as file:
-            json.dump(progress, file)
-        pBarMain.update(1)
-pBarMain.close()
+# file level deduplication (log_dedup.py), a file is checked against the ingested files it could repeat before parsing it
+def repeated_files(path, size):
+    """(size, hash, rows) of the ingested files a `size` byte file at `path` could repeat: the files of the same size
+    and the prefixes of the shorter earlier versions of `path`"""
+    cursor.execute("""SELECT size, hash, rows FROM ingested_files WHERE size = :size AND hash IS NOT NULL AND rows IS NOT NULL
+        UNION ALL SELECT prefix_size, prefix_hash, prefix_rows FROM ingested_files
+        WHERE path = :path AND prefix_hash IS NOT NULL AND prefix_size > 0 AND prefix_size < :size""", {"path":path, "size":size})
+    return cursor.fetchall()
+
+def dedup_file(raw, path, size):
+    """DedupReader of the log file read from the binary stream `raw`, positioned after what was already ingested.
+    Returns (reader, entries before its position, whether the whole file was already ingested)"""
+    reader = log_dedup.DedupReader(raw)
+    candidates = repeated_files(path, size)
+    if not candidates:
+        return reader, 0, False
+    with report.stage("dedup"):
+        match = reader.match_prefix(candidates)
+    if match == None:
+        return reader, 0, False
+    (matchSize, matchHash, matchRows) = match
+    if matchSize == size:
+        report.add_skipped(size, matchRows)
+        return reader, matchRows, True
+    reader.start = matchSize
+    report.add_skipped(matchSize, matchRows)
+    return reader, matchRows, False
+
+def ingest_file(reader, skippedRows, whole, dimension, path, size, mtime):
+    """Parse a log file from where dedup_file() left its reader in this process and mark it as ingested"""
+    start, inserted = time.perf_counter(), report.rows["inserted"]
+    batch, rowCount = [], 0
+    if not whole:
+        batch, rowCount = parse_log(codecs.getreader("utf-8")(reader), dimension, size - reader.start) # TextIOWrapper needs a seekable stream
+    finish_file(dimension, batch, path, size, mtime, reader.finish(), rowCount, skippedRows)
+    reader.close()
+    if not whole:
+        report.add_file(path, dimension, size - reader.start, rowCount, report.rows["inserted"] - inserted, time.perf_counter() - start)
+
+def write_rows(dimension, rows, path, size, mtime, hashes):
+    """Insert all rows of a file parsed by a worker, in batches of BATCH_SIZE"""
+    batches = [rows[start:start+BATCH_SIZE] for start in range(0, len(rows), BATCH_SIZE)] or [[]]
+    for batch in batches[:-1]:
+        insert_batch(dimension, batch)
+    finish_file(dimension, batches[-1], path, size, mtime, hashes, len(rows))
+
+# worker pool, results are written in submission order by this process only
+pool = ProcessPoolExecutor(opts.workers, initializer=logparser.set_timezone, initargs=(LOG_TIMEZONE,)) if opts.workers > 0 else None
+pending = deque()
+maxPending = opts.workers * 2 # back-pressure, stop reading logs while this many are parsed or waiting to be written
+
+def finish_oldest():
+    future, dimension, path, size, mtime = pending.popleft()
+    with report.stage("wait"):
+        rows, hashes, timings = future.result()
+    for stage, seconds in timings.items():
+        report.add(stage, seconds)
+    start, inserted = time.perf_counter(), report.rows["inserted"]
+    write_rows(dimension, rows, path, size, mtime, hashes)
+    report.add_file(path, dimension, size, len(rows), report.rows["inserted"] - inserted,
+        sum(timings.values()) + time.perf_counter() - start) # parse time in the worker plus write time here
+    pBarMain.set_postfix_str(dimension)
+
+def submit(function, argument, dimension, path, size, mtime):
+    """Parse on the pool, the rows get written to `dimension` once all earlier submissions are written"""
+    pending.append((pool.submit(function, argument), dimension, path, size, mtime))
+    while len(pending) >= maxPending:
+        finish_oldest()
+
+def finish_all():
+    while pending:
+        finish_oldest()
+
+def finish_repeated(path, size):
+    """Write the pending files a `size` byte file at `path` could repeat (see repeated_files), so dedup_file() finds them"""
+    if any(pendingSize == size or pendingPath == path for (future, dimension, pendingPath, pendingSize, mtime) in pending):
+        finish_all()
+
+def ingest_extracted():
+    global pBarMain
+    print(f"""unzipping
+{bcolors.BOLD}from: {bcolors.ENDC}"""+PATH_TO_ZIP_DIR+f"""
+{bcolors.BOLD}to: {bcolors.ENDC}"""+DIRECTORY_TO_EXTRACT_TO)
+    for fileName in (pBarFile := tqdm(files_in_dir)):
+        path_to_zip_file = PATH_TO_ZIP_DIR + fileName
+        pBarFile.write(f"extracting {fileName}")
+
+        with report.stage("extract"), tarfile.open(path_to_zip_file, 'r') as tar:
+            tar.extractall(DIRECTORY_TO_EXTRACT_TO)
+        pBarFile.write("unzipped: " + fileName)
+
+    print(f"{bcolors.OKBLUE}unzipped all{bcolors.ENDC}")
+
+    dimensionData = {
+        "dim":{},
+        "total_files":0,
+    }
+    for dimension in SQLITE3_DB_TABLES: # calculate total number of files in all dimensions
+        dimensionDir = os.path.join(DIRECTORY_TO_EXTRACT_TO, dimension + "/")
+        try:
+            logs_in_dir = [f for f in os.listdir(dimensionDir) if os.path.isfile(os.path.join(dimensionDir, f))] 
+            todo_logs_in_dir = []
+            for file in logs_in_dir:
+                stat = os.stat(dimensionDir + file)
+                if not file_ingested(dimensionDir + file, stat.st_size, stat.st_mtime):
+                    todo_logs_in_dir.append(file)
+        except:
+            logs_in_dir = []
+            todo_logs_in_dir = []
+        dimensionData["dim"][dimension] = {}
+        dimensionData["dim"][dimension]["logs_in_dir"] = logs_in_dir
+        dimensionData["dim"][dimension]["todo_logs_in_dir"] = todo_logs_in_dir
+        dimensionData["total_files"] += len(todo_logs_in_dir)
+
+    pBarMain = tqdm(total=dimensionData["total_files"])
+    for i, dimension in enumerate(SQLITE3_DB_TABLES): # actually parse the files
+        dimsDone = str(i+1)
+        dimsTotal = str(len(SQLITE3_DB_TABLES))
+        padZero = len(dimsTotal) - len(dimsDone)
+        dimsDone = padZero*"0" + dimsDone
+        pBarMain.set_description_str(f"{dimsDone}/{dimsTotal} Dimensions")
+        dimensionDir = os.path.join(DIRECTORY_TO_EXTRACT_TO, dimension + "/")
         
+        logs_in_dir = dimensionData["dim"][dimension]["logs_in_dir"]
+        todo_logs_in_dir = dimensionData["dim"][dimension]["todo_logs_in_dir"]
+        skippedFiles = len(logs_in_dir) - len(todo_logs_in_dir)
+        if skippedFiles > 0:
+            print(f"{bcolors.BOLD + bcolors.WARNING}Skipped {skippedFiles} files, already parsed{bcolors.ENDC}")
+
+        loopIter = tqdm(todo_logs_in_dir) if SHOW_FILE_FOLDER_BAR  else todo_logs_in_dir
+        for fileName in loopIter:
+            filePath = dimensionDir + fileName
+            stat = os.stat(filePath)
+            if LOG_FILE:
+                pBarMain.write(f"Parsing {filePath}")
+            finish_repeated(filePath, stat.st_size)
+            with open(filePath, "rb") as raw:
+                reader, skippedRows, whole = dedup_file(raw, filePath, stat.st_size)
+                if pool and reader.start == 0 and not whole: # the worker reads the file itself
+                    reader.close()
+                    submit(logparser.parse_path, filePath, dimension, filePath, stat.st_size, stat.st_mtime)
+                else:
+                    ingest_file(reader, skippedRows, whole, dimension, filePath, stat.st_size, stat.st_mtime)
+            pBarMain.update(1)
+    finish_all()
+    pBarMain.close()
+
+def ingest_streamed():
+    """Parse the logs straight out of the archives, skipping archives and members that were already ingested"""
+    global pBarMain
+    todo_archives = []
+    for fileName in files_in_dir:
+        stat = os.stat(PATH_TO_ZIP_DIR + fileName)
+        if not archive_ingested(fileName, stat.st_size, stat.st_mtime):
+            todo_archives.append(fileName)
+    skippedArchives = len(files_in_dir) - len(todo_archives)
+    if skippedArchives > 0:
+        print(f"{bcolors.BOLD + bcolors.WARNING}Skipped {skippedArchives} archives, already parsed{bcolors.ENDC}")
+
+    print(f"{bcolors.BOLD}streaming from: {bcolors.ENDC}"+PATH_TO_ZIP_DIR)
+    pBarMain = tqdm(total=len(todo_archives))
+    for fileName in todo_archives:
+        pBarMain.set_description_str(fileName)
+        path_to_zip_file = PATH_TO_ZIP_DIR + fileName
+        skippedMembers = 0
+        # stream mode reads (and decompresses) the archive once, front to back
+        with tarfile.open(path_to_zip_file, 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                dimension = os.path.basename(os.path.dirname(os.path.normpath(member.name)))
+                if dimension not in SQLITE3_DB_TABLES:
+                    continue
+                if file_ingested(member.name, member.size, member.mtime): # same file seen in an earlier archive
+                    skippedMembers += 1
+                    continue
+                if LOG_FILE:
+                    pBarMain.write(f"Parsing {fileName}/{member.name}")
+                raw = tar.extractfile(member) # reading includes decompressing
+                if pool:
+                    with report.stage("read"):
+                        data = raw.read()
+                    raw = io.BytesIO(data)
+                finish_repeated(member.name, member.size)
+                reader, skippedRows, whole = dedup_file(raw, member.name, member.size)
+                if pool and reader.start == 0 and not whole:
+                    reader.close()
+                    submit(logparser.parse_bytes, data, dimension, member.name, member.size, member.mtime)
+                    continue
+                ingest_file(reader, skippedRows, whole, dimension, member.name, member.size, member.mtime)
+                pBarMain.set_postfix_str(dimension)
+        finish_all()
+        if skippedMembers > 0:
+            pBarMain.write(f"{bcolors.BOLD + bcolors.WARNING}Skipped {skippedMembers} files in {fileName}, already parsed{bcolors.ENDC}")
+
+        stat = os.stat(path_to_zip_file)
+        cursor.execute("INSERT OR REPLACE INTO ingested_archives VALUES (?, ?, ?, ?)",
+            (fileName, stat.st_size, int(stat.st_mtime), round(time.time())))
+        conn.commit()
+        pBarMain.update(1)
+    pBarMain.close()
+
+# live logs, the read offset of every followed file is committed together with the entries read up to it
+FOLLOW_READ_SIZE = 4 << 20 # most bytes read from one file per check, a bigger backlog is caught up over several checks
+FOLLOW_TAIL_SIZE = 64 # bytes before the offset that are kept to notice a file that was truncated and written again
+
+def follow_targets(followed):
+    """Stat every live log and work out where to continue reading it. `followed` maps path: (inode, offset, tail), a file with a new
+    inode continues at the offset of the path that inode had before (rotated by renaming), otherwise it is a new file.
+    Returns {path: (dimension, stat, offset, tail)}"""
+    byInode = {inode: path for path, (inode, offset, tail) in followed.items()}
+    targets = {}
+    for dimension in SQLITE3_DB_TABLES:
+        dimensionDir = os.path.join(LIVE_LOG_DIR, dimension)
+        if not os.path.isdir(dimensionDir):
+            continue
+        for fileName in os.listdir(dimensionDir):
+            path = os.path.join(dimensionDir, fileName)
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            inode, offset, tail = followed.get(path, (None, 0, b""))
+            if inode != stat.st_ino:
+                inode, offset, tail = followed[byInode[stat.st_ino]] if stat.st_ino in byInode else (None, 0, b"")
+            if stat.st_size < offset: # truncated, start over
+                offset, tail = 0, b""
+            targets[path] = (dimension, stat, offset, tail)
+    return targets
+
+def follow_read(path, offset, tail):
+    """Groups of the complete entries after `offset`, the offset and tail after the last one and whether the read was cut off at FOLLOW_READ_SIZE"""
+    with open(path, "rb") as f:
+        f.seek(offset - len(tail))
+        data = f.read(len(tail) + FOLLOW_READ_SIZE)
+    if data[:len(tail)] != tail: # truncated and written past the old offset again since the last check
+        return follow_read(path, 0, b"")
+    data = data[len(tail):]
+    text = codecs.getincrementaldecoder("utf-8")().decode(data) # leaves out a character that is cut off at the end
+    groups, end = logparser.complete_groups(text)
+    end = len(text[:end].encode("utf-8"))
+    return groups, offset + end, (tail + data[:end])[-FOLLOW_TAIL_SIZE:], len(data) == FOLLOW_READ_SIZE
+
+def follow():
+    """Ingest the entries appended to the live logs, committing at least every --commit-interval seconds, until interrupted"""
+    cursor.execute("""CREATE TABLE if not exists followed_files (
+        `path` TEXT PRIMARY KEY,
+        `inode` INTEGER NOT NULL,
+        `offset` INTEGER NOT NULL,
+        `tail` BLOB NOT NULL,
+        `update_time` INTEGER NOT NULL)
+        """)
+    conn.commit()
+    cursor.execute("SELECT path, inode, offset, tail FROM followed_files")
+    followed = {path: (inode, offset, tail) for path, inode, offset, tail in cursor.fetchall()}
+    batches = {dimension: [] for dimension in SQLITE3_DB_TABLES}
+    changed = False
+
+    def commit():
+        for dimension, batch in batches.items():
+            if batch:
+                insert_batch(dimension, batch, commit=False)
+                batch.clear()
+        now = round(time.time())
+        cursor.execute("DELETE FROM followed_files")
+        cursor.executemany("INSERT INTO followed_files VALUES (?, ?, ?, ?, ?)",
+            [(path, inode, offset, tail, now) for path, (inode, offset, tail) in followed.items()])
+        with report.stage("commit"):
+            conn.commit()
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    print(f"{bcolors.BOLD}following: {bcolors.ENDC}{LIVE_LOG_DIR} (ctrl+c to stop)")
+    lastCommit = time.monotonic()
+    try:
+        while True:
+            behind = False
+            targets = follow_targets(followed)
+            changed = changed or targets.keys() != followed.keys()
+            for path, (dimension, stat, offset, tail) in targets.items():
+                if stat.st_size > offset:
+                    groups, offset, tail, cutOff = follow_read(path, offset, tail)
+                    behind = behind or cutOff
+                    batches[dimension] += [logparser.groups_to_row(group) for group in groups]
+                    report.rows["parsed"] += len(groups)
+                    if LOG_FILE and groups:
+                        print(f"{len(groups)} new entries in {path}")
+                changed = changed or followed.get(path) != (stat.st_ino, offset, tail)
+                followed[path] = (stat.st_ino, offset, tail)
+            for path in followed.keys() - targets.keys(): # gone
+                del followed[path]
+            pendingRows = sum(len(batch) for batch in batches.values())
+            if changed and (pendingRows > BATCH_SIZE or time.monotonic() - lastCommit >= opts.commit_interval):
+                if LOG_BATCH and pendingRows:
+                    print(f"committing {pendingRows} live entries")
+                commit()
+                changed = False
+                lastCommit = time.monotonic()
+            if not behind:
+                time.sleep(opts.poll)
+    except KeyboardInterrupt:
+        commit()
+        print(f"{bcolors.OKBLUE}stopped following{bcolors.ENDC}")
+
+def rate(rows, seconds):
+    return f"{rows} rows in {seconds:.2f}s ({rows / max(seconds, 1e-9):.0f} rows/s)"
+
+def merge_staging():
+    """Dedupe every leftover staging table into its real table (or its monthly partitions) with one set based insert each, then drop it.
+    Secondary indexes are dropped before the merge and rebuilt afterwards, the UNIQUE constraint is part of
+    the table so it stays, but the rows go in sorted on its columns so its b-tree only gets appended to"""
+    for table in SQLITE3_DB_TABLES:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (staging_table(table),))
+        if cursor.fetchone() == None:
+            continue
+        cursor.execute(f"SELECT COUNT(*) FROM \"{staging_table(table)}\"")
+        staged = cursor.fetchone()[0]
+        if staged == 0:
+            cursor.execute(f'DROP TABLE "{staging_table(table)}"')
+            conn.commit()
+            continue
+        cursor.execute(f'PRAGMA table_info("{table}")')
+        columns = [column[1] for column in cursor.fetchall()]
+        uniqueColumns = [column for column in columns if column not in ("lower_username", "UUID")]
+
+        if PARTITION_MONTHLY:
+            cursor.execute(f'SELECT DISTINCT UNIX_time / 86400 FROM "{staging_table(table)}"')
+            numbers = sorted(set(database.month_number(day * 86400) for (day,) in cursor.fetchall()))
+            targets = []
+            for number in numbers:
+                (monthStart, monthEnd) = database.month_range(number)
+                targets.append((partition_of(table, monthStart), f"WHERE UNIX_time >= {monthStart} AND UNIX_time < {monthEnd}"))
+            conn.commit() # new partitions
+        else:
+            targets = [(table, "")]
+
+        added = 0
+        mergeSeconds, indexSeconds, indexCount = 0, 0, 0
+        for target, where in targets:
+            cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (target,))
+            indexes = cursor.fetchall()
+            for name, sql in indexes:
+                cursor.execute(f'DROP INDEX "{name}"')
+
+            start = time.perf_counter()
+            cursor.execute(f"""INSERT OR IGNORE INTO "{target}"
+                SELECT DISTINCT {", ".join(columns)}
+                FROM "{staging_table(table)}" {where}
+                ORDER BY {", ".join(uniqueColumns)}""")
+            added += cursor.rowcount
+            if cursor.rowcount > 0:
+                database.bump_generation(cursor)
+            conn.commit()
+            mergeSeconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            for name, sql in indexes:
+                cursor.execute(sql)
+            conn.commit()
+            indexSeconds += time.perf_counter() - start
+            indexCount += len(indexes)
+        cursor.execute(f'DROP TABLE "{staging_table(table)}"')
+        conn.commit()
+        report.add("merge", mergeSeconds)
+        report.rows["inserted"] -= staged - added # these were counted when they went into the staging table
+        report.rows["ignored"] += staged - added
+        print(f"dedupe {table}: {staged} staged, {added} new, {staged - added} duplicates, {rate(staged, mergeSeconds)}")
+
+        report.add("index_build", indexSeconds, indexCount)
+        report.merges.append({"table":table, "staged":staged, "added":added, "duplicates":staged - added, "partitions":len(targets) if PARTITION_MONTHLY else 0,
+            "merge_seconds":round(mergeSeconds, 4), "indexes":indexCount, "index_seconds":round(indexSeconds, 4)})
+        if indexCount:
+            print(f"index build {table}: {indexCount} indexes in {indexSeconds:.2f}s")
+
+loadStart = time.perf_counter()
+if opts.follow:
+    follow()
+elif opts.extract:
+    ingest_extracted()
+else:
+    ingest_streamed()
+
+if pool:
+    pool.shutdown()
+
+if opts.bulk:
+    print(f"bulk load: {rate(entriesAdded, time.perf_counter() - loadStart)}")
+merge_staging() # also picks up staging tables left behind by a crashed bulk run
+with report.stage("checkpoint"): # leave an empty WAL behind, waits (busy timeout) for lookups still reading the old one
+    (busy, walPages, checkpointed) = database.checkpoint(cursor, "TRUNCATE")
+if busy and not LOG_NONE:
+    print(f"{bcolors.WARNING}WAL checkpoint did not finish ({checkpointed} of {walPages} pages), lookups were still reading{bcolors.ENDC}")
 
 print(f"Successfully added {entriesAdded} entries to {len(SQLITE3_DB_TABLES)} tables")
+print(f"{report.rows["parsed"]} parsed, {report.rows["inserted"]} inserted, {report.rows["ignored"]} ignored as duplicates")
+if report.skipped["files"] > 0:
+    print(f"{report.skipped["files"]} files repeated ingested logs, skipped {report.skipped["bytes"] / 2**20:.1f}MiB with {report.skipped["rows"]} entries without parsing")
+if opts.profile:
+    profileTop = report.stop_profile(opts.profile)
+    print(f"cProfile stats written to {opts.profile}")
+if opts.report:
+    print(report.summary())
+    report.write(opts.report, args=sys.argv[1:], workers=opts.workers, bulk=opts.bulk, extract=opts.extract,
+        batch_size=BATCH_SIZE, compact={table: compactTables[table] for table in SQLITE3_DB_TABLES},
+        **({"profile_top":profileTop.splitlines()} if opts.profile else {}))
+    print(f"report written to {opts.report}")
 # print(f"{duplicatesSkipped != 0 and bcolors.WARNING or ""}Skipped {duplicatesSkipped} duplicate entries")
 # tying up loose ends
-conn.close()
\ No newline at end of file
+conn.close()
@@ -1,12 +1,14 @@
 from copy import copy
 import optparse
-import time, sys, os, sqlite3, re, json
+import time, sys, os, sqlite3, re, json, base64, math, shutil, signal, socket, socketserver, bisect, datetime, threading, difflib
+from collections import deque
 from dotenv import load_dotenv
+import database, query_client, result_cache, snapshot
 
 # get the current working directory
 current_working_directory = os.getcwd()
-# get terminal size
-width, height = os.get_terminal_size()
+# get terminal size (falls back to 80x24 when there is no terminal, like when called from minecraft)
+width, height = shutil.get_terminal_size()
 
 # settings
 load_dotenv()
@@ -26,6 +28,17 @@ except ValueError as e:
 LOG_NONE = os.getenv('LOG_NONE').lower() in ("true", "t", "1")
 LOG_BATCH = os.getenv('LOG_BATCH').lower() in ("true", "t", "1") and not LOG_NONE
 LOG_EVERY = os.getenv('LOG_EVERY').lower() in ("true", "t", "1") and not LOG_NONE
+try:
+    QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE') or 256)
+except ValueError as e:
+    raise ValueError(f"Invalid integer in QUERY_CACHE_SIZE environment variable. Error: {e}") from e
+QUERY_CACHE_FILE = os.getenv('QUERY_CACHE_FILE') or None # optional second cache tier shared by query.py processes
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR') or "./snapshot/" # columnar snapshot for --engine snapshot
+try:
+    QUERY_POOL_SIZE = int(os.getenv('QUERY_POOL_SIZE') or 4)
+    QUERY_MMAP_MB = int(os.getenv('QUERY_MMAP_MB') or 256)
+except ValueError as e:
+    raise ValueError(f"Invalid integer in QUERY_POOL_SIZE/QUERY_MMAP_MB environment variable. Error: {e}") from e
 regexPattern = r'(-?\d+)#(-?\d+)#(-?\d+)#(\w)#([^#]*)#(\d{2}\/\d{2}\/\d{2}) (\d{2}:\d{2}:\d{2})#([^,\]]*)'
 
 # assert valid environment variables
@@ -53,12 +66,11 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 # STARTING CODE
-# create SQLite db connection
-conn = sqlite3.connect(SQLITE3_DB_FILE)
-cursor = conn.cursor()
-
-# pregened sql queries
-ALL_TABLES = "UNION ALL ".join(map(lambda table: f"SELECT * FROM {table} ", SQLITE3_DB_TABLES))
+# create SQLite db connections: lookups read through a pool of read-only connections (one per thread, so --serve can
+# answer lookups side by side and never waits on main.py), the maintenance commands write through conn
+conn = sqlite3.connect(SQLITE3_DB_FILE, timeout=30)
+readPool = database.ReadPool(SQLITE3_DB_FILE, QUERY_POOL_SIZE, mmapMiB=QUERY_MMAP_MB)
+cursor = database.PooledCursor(readPool)
 
 # exit best as posible
 def exit_prgm():
@@ -228,9 +240,11 @@ def process_params(paramsInput):
             key, value = param.split(":", maxsplit=1)
         except:
             continue
+        if key not in paramsSettings:
+            raise ValueError(f"'{key}' is not a valid parameter, use one of {", ".join(paramsSettings)}")
         
         negative = False
-        if value[0] == "!":
+        if value.startswith("!"):
             if paramsSettings[key]["allowNegative"]:
                 negative = True
                 value = value[1:]
@@ -247,54 +261,203 @@ def process_params(paramsInput):
         parsedParams[key].append({"value":value,"negative":negative})
     return parsedParams
 
-def format_query(pos, params):
-    tables = SQLITE3_DB_TABLES
-    posWorldCheck = False
+def query_tables(params):
+    """Tables a lookup reads, from its world: parameters: the positive worlds (all when there are none) minus the negative ones"""
     for world in params["world"]:
-        value = world["value"]
-        if value not in SQLITE3_DB_TABLES:
-            raise ValueError(f"world '{value}' is not available (is your .env setup correctly?)")
-        if world["negative"]:
-            tables.remove(value)
-        elif posWorldCheck:
-            tables.append(value)
-        else:
-            tables = [value]
-    tables = "UNION ALL ".join(map(lambda table: f"SELECT * FROM {table} ", tables))
-    
-    whereChecks = []
-    # position check
+        if world["value"] not in SQLITE3_DB_TABLES:
+            raise ValueError(f"world '{world["value"]}' is not available (is your .env setup correctly?)")
+    positive = [world["value"] for world in params["world"] if not world["negative"]]
+    negative = [world["value"] for world in params["world"] if world["negative"]]
+    return [table for table in SQLITE3_DB_TABLES if (len(positive) == 0 or table in positive) and table not in negative]
+
+def query_window(params):
+    """(after, before) UNIX times of a lookup, None when it has no such parameter"""
+    after = int(params["after"][0]["value"]) if len(params["after"]) > 0 else None
+    before = int(params["before"][0]["value"]) if len(params["before"]) > 0 else None
+    return (after, before)
+
+def event_tables():
+    """Every table with entries of SQLITE3_DB_TABLES, the dimension tables and their time partitions"""
+    return SQLITE3_DB_TABLES + [partition[0] for partition in database.partitions(cursor) if partition[1] in SQLITE3_DB_TABLES]
+
+def query_radius(params):
     try:
-        radius = params["range"][0]["value"]
+        return params["range"][0]["value"]
     except:
-        radius = 1
-    whereChecks.append(f"""
-    (x - {pos[0]}) * (x - {pos[0]}) + 
-    (y - {pos[1]}) * (y - {pos[1]}) + 
-    (z - {pos[2]}) * (z - {pos[2]}) <= {radius**2}"""
-    ) 
-    # action check
-    for action in params["action"]:
-        whereChecks.append(f"interaction {"!" if action["negative"] else "="}= '{action["value"]}'")
-    # object check
-    for object in params["object"]:
-        whereChecks.append(f"block {"!" if object["negative"] else "="}= '{object["value"]}'")
-    # source check
-    for source in params["source"]:
-        whereChecks.append(f"username {"!" if source["negative"] else "="}= '{source["value"]}'")
-    # before
-    if len(params["before"]) > 0:
-        whereChecks.append(f"UNIX_time <= {params["before"][0]["value"]}")
-    # after
-    if len(params["after"]) > 0:
-        whereChecks.append(f"UNIX_time >= {params["after"][0]["value"]}")
-
-
-    dbQuery = f"SELECT * FROM ({tables}) WHERE {" AND ".join(whereChecks)} ORDER BY UNIX_time desc"
-    print(dbQuery)
-    return dbQuery
-
-def show_page(index, dbQuery, limit = 10, total = None):
+        return 1
+
+# lookups compile to SQL with bound parameters. Every branch of the union (a dimension table or one of its partitions)
+# gets the whole WHERE clause, its bounding box prefilter and its own ORDER BY/LIMIT, so the planner can use the
+# indexes of each table. The SQL text only depends on the shape of the lookup, the sqlite3 module keeps a prepared
+# statement per SQL text, so lookups with other values reuse it
+BOX_BINDINGS = ((":minX", ":maxX"), (":minY", ":maxY"), (":minZ", ":maxZ"))
+
+def compile_filters(pos, params, after_key=None):
+    """(WHERE clause for a row of any branch, bindings) of a lookup, `dimension` and `row_id` are left as {dimension} and {row_id}"""
+    ((minX, maxX), (minY, maxY), (minZ, maxZ)) = database.sphere_box(pos, query_radius(params))
+    (x, y, z) = map(int, pos)
+    bindings = {"x":x, "y":y, "z":z, "radiusSquared":query_radius(params) ** 2,
+        "minX":minX, "maxX":maxX, "minY":minY, "maxY":maxY, "minZ":minZ, "maxZ":maxZ}
+    checks = ["(x - :x) * (x - :x) + (y - :y) * (y - :y) + (z - :z) * (z - :z) <= :radiusSquared"]
+    for name, column in (("action", "interaction"), ("object", "block"), ("source", "lower_username")):
+        for i, check in enumerate(params[name]):
+            checks.append(f"{column} {"!" if check["negative"] else "="}= :{name}{i}")
+            bindings[f"{name}{i}"] = check["value"]
+    (after, before) = query_window(params)
+    if before != None:
+        checks.append("UNIX_time <= :before")
+        bindings["before"] = before
+    if after != None:
+        checks.append("UNIX_time >= :after")
+        bindings["after"] = after
+    # continue after the last row of the previous page
+    if after_key != None:
+        checks.append("(UNIX_time, {dimension}, {row_id}) < (:keyTime, :keyDimension, :keyRowId)")
+        bindings.update({"keyTime":int(after_key[0]), "keyDimension":after_key[1], "keyRowId":int(after_key[2])})
+    return (" AND ".join(checks), bindings)
+
+def compile_query(pos, params, after_key=None, limit=None, offset=0, count=False, ordered=True):
+    """(sql, bindings) of a lookup: its rows (EVENT_COLUMNS, dimension, row_id) newest first (in any order with
+    ordered=False), `limit` rows after the first `offset` when limit is given, or its number of rows with count=True"""
+    (where, bindings) = compile_filters(pos, params, after_key)
+    (after, before) = query_window(params)
+    branches = []
+    for dimension in query_tables(params):
+        # only the partitions that can hold entries within before:/after:
+        for (table, number) in database.dimension_sources(cursor, dimension, after, before):
+            (source, rowid) = database.read_source(cursor, table)
+            rowId = database.partition_row_id(number, rowid)
+            # dimension and row_id make (UNIX_time, dimension, row_id) a unique, sortable key for keyset paging
+            columns = f"{database.EVENT_COLUMNS}, '{dimension}' AS dimension, {rowId} AS row_id"
+            if database.has_spatial_index(cursor, table): # probe the bounding box first
+                box = database.box_filter(table, BOX_BINDINGS, rowid)
+            else: # the unique index starts with x
+                box = "x BETWEEN :minX AND :maxX AND y BETWEEN :minY AND :maxY AND z BETWEEN :minZ AND :maxZ"
+            branchWhere = f"{box} AND {where.format(dimension=f"'{dimension}'", row_id=rowId)}"
+            if count:
+                branches.append(f"SELECT COUNT(*) AS entries FROM {source} WHERE {branchWhere}")
+            elif limit != None: # no branch has to return more than the rows up to the end of the page
+                branches.append(f"SELECT * FROM (SELECT {columns} FROM {source} WHERE {branchWhere} ORDER BY UNIX_time DESC, {rowId} DESC LIMIT :branchLimit)")
+            else:
+                branches.append(f"SELECT {columns} FROM {source} WHERE {branchWhere}")
+    if count:
+        return (f"SELECT COALESCE(SUM(entries), 0) FROM ({" UNION ALL ".join(branches)})", bindings)
+    dbQuery = f"SELECT * FROM ({" UNION ALL ".join(branches)})"
+    if ordered or limit != None:
+        dbQuery += " ORDER BY UNIX_time DESC, dimension DESC, row_id DESC"
+    if limit != None:
+        dbQuery += " LIMIT :limit OFFSET :offset"
+        bindings.update({"limit":limit, "offset":offset, "branchLimit":limit + offset})
+    return (dbQuery, bindings)
+
+# results per normalized query: the total and the (UNIX_time, dimension, row_id) keys of the first MAX_CACHED_ROWS rows,
+# pages within those are read by row id instead of running the lookup again
+MAX_CACHED_ROWS = 1000
+resultCache = result_cache.ResultCache(QUERY_CACHE_SIZE, QUERY_CACHE_FILE)
+snapshotEngine = None # snapshot.Snapshot with --engine snapshot, lookups it does not cover (stale, other tables) use SQL
+
+def query_key(pos, params):
+    """Same key for the same lookup, whatever the order of its parameters"""
+    normalized = {name: sorted(values, key=lambda value: json.dumps(value, sort_keys=True)) for name, values in params.items()}
+    return json.dumps([[int(coordinate) for coordinate in pos], normalized], sort_keys=True)
+
+def cached_result(pos, params):
+    """{"total", "keys"} of a lookup, cached until main.py adds entries. None when the database has no ingest generation"""
+    generation = database.read_generation(cursor)
+    if generation == None:
+        return None
+    resultCache.set_generation(generation)
+    key = query_key(pos, params)
+    result = resultCache.get(key)
+    if result == None:
+        (dbQuery, bindings) = compile_query(pos, params, limit=MAX_CACHED_ROWS + 1)
+        cursor.execute(f"SELECT UNIX_time, dimension, row_id FROM ({dbQuery})", bindings)
+        keys = cursor.fetchall()
+        total = len(keys)
+        if total > MAX_CACHED_ROWS:
+            total = count_results(pos, params)
+        result = {"total":total, "keys":[list(rowKey) for rowKey in keys[:MAX_CACHED_ROWS]]}
+        resultCache.put(key, result, generation)
+    return result
+
+def count_results(pos, params):
+    cursor.execute(*compile_query(pos, params, count=True))
+    return cursor.fetchone()[0]
+
+def rows_by_keys(keys):
+    """The result rows of (UNIX_time, dimension, row_id) keys, in the same order"""
+    rows = {}
+    for (dimension, number) in set((rowKey[1], database.split_row_id(rowKey[2])[0]) for rowKey in keys):
+        (source, rowid) = database.read_source(cursor, database.partition_table(dimension, number))
+        ids = ",".join(str(database.split_row_id(int(rowKey[2]))[1]) for rowKey in keys if (rowKey[1], database.split_row_id(rowKey[2])[0]) == (dimension, number))
+        cursor.execute(f"SELECT {database.EVENT_COLUMNS}, '{dimension}' AS dimension, {database.partition_row_id(number, rowid)} AS row_id FROM {source} WHERE {rowid} IN ({ids})")
+        for row in cursor.fetchall():
+            rows[(dimension, row[10])] = row
+    return [rows[(rowKey[1], rowKey[2])] for rowKey in keys if (rowKey[1], rowKey[2]) in rows]
+
+# continuation tokens, opaque to the caller, carry everything needed to show the next page
+def encode_token(pos, params, key, page, total):
+    data = json.dumps({"pos":list(pos),"params":params,"key":key,"page":page,"total":total}, separators=(",",":"))
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+def check_token_params(params):
+    """Raise a ValueError unless `params` has the structure process_params() returns"""
+    if not isinstance(params, dict) or params.keys() != paramsSettings.keys():
+        raise ValueError("parameters of another shape")
+    for key, checks in params.items():
+        if not isinstance(checks, list) or (len(checks) > 1 and not paramsSettings[key]["allowMultiple"]):
+            raise ValueError(f"parameter '{key}' of another shape")
+        for check in checks:
+            if not isinstance(check, dict) or check.keys() != {"value", "negative"} or not isinstance(check["negative"], bool) \
+                    or type(check["value"]) != paramsSettings[key]["type"]:
+                raise ValueError(f"parameter '{key}' of another shape")
+            if key in ("before", "after"): # UNIX times
+                int(check["value"])
+
+def decode_token(token):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode()))
+        (pos, params, key, page, total) = (tuple(data["pos"]), data["params"], data["key"], data["page"], data["total"])
+        check_token_params(params)
+        [int(coordinate) for coordinate in pos]
+        if len(pos) != 3 or type(page) != int or type(total) != int or (key != None and (type(key) != list or len(key) != 3)):
+            raise ValueError("position, page or key of another shape")
+        return (pos, params, key, page, total)
+    except (ValueError, KeyError, TypeError, AttributeError) as err:
+        raise ValueError("Invalid continuation token") from err
+
+def fetch_page(pos, params, page=0, key=None, limit=10, total=None):
+    """Fetch one page of results, by keyset when the key of the previous page's last row is known,
+    otherwise by offset. Pages within the cached keys of the lookup are read by row id.
+    Returns (results, total, token of the next page or None)"""
+    tables = query_tables(params)
+    resolve_sources(params)
+    results = None
+    if snapshotEngine != None and snapshotEngine.covers(tables, database.read_generation(cursor)):
+        (after, before) = query_window(params)
+        checks = [(column, check["value"], check["negative"]) for name, column in (("action", "interaction"), ("object", "block"), ("source", "lower_username")) for check in params[name]]
+        (results, total) = snapshotEngine.lookup(tables, pos, query_radius(params), checks, after, before, key=key, limit=limit, offset=0 if key != None else page * limit)
+    cached = cached_result(pos, params) if results == None else None
+    if cached != None:
+        (total, keys) = (cached["total"], cached["keys"])
+        start = page * limit if key == None else next((i for i, rowKey in enumerate(keys) if tuple(rowKey) < tuple(key)), len(keys))
+        if start + limit <= len(keys) or len(keys) == total:
+            results = rows_by_keys(keys[start:start+limit])
+    if results == None:
+        if total == None:
+            total = count_results(pos, params)
+        if key != None:
+            cursor.execute(*compile_query(pos, params, after_key=key, limit=limit))
+        else:
+            cursor.execute(*compile_query(pos, params, limit=limit, offset=page * limit))
+        results = cursor.fetchall()
+    nextToken = None
+    if len(results) == limit and (page+1) * limit < total:
+        last = results[-1]
+        nextToken = encode_token(pos, params, [last[7], last[9], last[10]], page+1, total)
+    return (results, total, nextToken)
+
+def show_page(index, results, total, nextToken = None, limit = 10):
     actionDisplay = {
         "p": "placed",
         "b": "broke",
@@ -302,22 +465,29 @@ def show_page(index, dbQuery, limit = 10, total = None):
         "o": "opened",
         "c": "did 'c'",
     }
-    if total == None:
-        cursor.execute(f"SELECT COUNT(*) FROM ({dbQuery})")
-        total = cursor.fetchone()[0]
-    cursor.execute(f"{dbQuery} LIMIT {index * limit}, {limit}")
-    results = cursor.fetchall()
     sideWidth = 15
     side = "="*sideWidth
     print(f"{bcolors.CYAN}{side} Searching logs {side}{bcolors.ENDC}")
     for result in results:
         print(f"{formatTimeAgo(result[7])} ago {bcolors.BLUE}{result[4]}{bcolors.ENDC} {actionDisplay[result[3]]} {bcolors.OKBLUE}{result[8]}{bcolors.ENDC} {bcolors.BLUE}{" ".join(map(str,result[0:3]))}{bcolors.ENDC}")
-    print(f"{bcolors.CYAN}{side} << [Page {index+1} of {total}] >> {side}{bcolors.ENDC}")
+    print(f"{bcolors.CYAN}{side} << [Page {index+1} of {max(1, math.ceil(total / limit))}] >> {side}{bcolors.ENDC}")
+    if nextToken:
+        print(f"next page: query.py -c {nextToken}")
+
+def mc_color_text(text, color, insertion = None):
+    """Chat component json of `text`, escaped so names, blocks and error messages can hold any character"""
+    component = {"color":color, "text":text}
+    if insertion:
+        component["insertion"] = insertion
+    return json.dumps(component, ensure_ascii=False)
 
-def mc_color_text(text, color):
-    return '{"color":"'+color+'","text":"' + text + '"}'
+def error_text(err):
+    """Message of an error of a request, a KeyError only holds the missing key"""
+    if isinstance(err, KeyError):
+        return f"request has no {err} key"
+    return str(err)
 
-def show_page_mc(index, dbQuery, limit = 10, total = None):
+def show_page_mc(index, results, total, nextToken = None, limit = 10):
     actionDisplay = {
         "p": "placed",
         "b": "broke",
@@ -325,11 +495,6 @@ def show_page_mc(index, dbQuery, limit = 10, total = None):
         "o": "opened",
         "c": "did 'c'",
     }
-    if total == None:
-        cursor.execute(f"SELECT COUNT(*) FROM ({dbQuery})")
-        total = cursor.fetchone()[0]
-    cursor.execute(f"{dbQuery} LIMIT {index * limit}, {limit}")
-    results = cursor.fetchall()
     sideWidth = 15
     side = "="*sideWidth
     output = []
@@ -346,10 +511,84 @@ def show_page_mc(index, dbQuery, limit = 10, total = None):
             f"{result[8]} ", "aqua"))
         output.append(mc_color_text(
             f"{" ".join(map(str,result[0:3]))}", "blue"))
+    # shift clicking the footer inserts the continuation token for the next page
     output.append(mc_color_text(
-        f"{side} << [Page {index+1} of {total}] >> {side}", "dark_aqua"))
+        f"{side} << [Page {index+1} of {max(1, math.ceil(total / limit))}] >> {side}", "dark_aqua", insertion = nextToken))
     return "[" + ",".join(output) + "]"
 
+# ledger: the net result of a lookup's area, the latest block change of every position and what every player placed
+# and broke there. Reduced from one unordered pass over the rows of the lookup, the spatial index does the filtering
+def ledger(pos, params):
+    """(latest place/break row of every (dimension, x, y, z) newest first, [(username, placed, broken)] by net change)"""
+    resolve_sources(params)
+    (dbQuery, bindings) = compile_query(pos, params, ordered=False)
+    cursor.execute(dbQuery, bindings)
+    latest = {}
+    players = {} # lower_username: [username, placed, broken]
+    while rows := cursor.fetchmany(10000):
+        for row in rows:
+            if row[3] not in ("p", "b"):
+                continue
+            position = (row[9], row[0], row[1], row[2])
+            if position not in latest or (row[7], row[10]) > (latest[position][7], latest[position][10]):
+                latest[position] = row
+            counts = players.setdefault(row[5], [row[4], 0, 0])
+            counts[1 if row[3] == "p" else 2] += 1
+    changes = sorted(latest.values(), key=lambda row: (row[7], row[9], row[10]), reverse=True)
+    players = sorted((tuple(counts) for counts in players.values()), key=lambda counts: (counts[1] - counts[2], counts[1]), reverse=True)
+    return (changes, players)
+
+def show_ledger(index, changes, players, limit = 10):
+    sideWidth = 15
+    side = "="*sideWidth
+    print(f"{bcolors.CYAN}{side} Ledger {side}{bcolors.ENDC}")
+    for (username, placed, broken) in players[:limit]:
+        print(f"{bcolors.BLUE}{username}{bcolors.ENDC}: {placed - broken:+} ({placed} placed, {broken} broken)")
+    if len(players) > limit:
+        print(f"... and {len(players) - limit} more players")
+    print(f"{bcolors.CYAN}latest change of {len(changes)} blocks:{bcolors.ENDC}")
+    for result in changes[index*limit:(index+1)*limit]:
+        print(f"{bcolors.BLUE}{" ".join(map(str,result[0:3]))}{bcolors.ENDC} {result[4]} {"placed" if result[3] == "p" else "broke"} {bcolors.OKBLUE}{result[8]}{bcolors.ENDC} {formatTimeAgo(result[7])} ago")
+    print(f"{bcolors.CYAN}{side} << [Page {index+1} of {max(1, math.ceil(len(changes) / limit))}] >> {side}{bcolors.ENDC}")
+
+def show_ledger_mc(index, changes, players, limit = 10):
+    sideWidth = 15
+    side = "="*sideWidth
+    output = []
+    output.append(mc_color_text(
+        f"{side} Ledger {side}\n", "dark_aqua"))
+    for (username, placed, broken) in players[:limit]:
+        output.append(mc_color_text(
+            f"{username}", "blue"))
+        output.append(mc_color_text(
+            f": {placed - broken:+} ({placed} placed, {broken} broken)\n", "white"))
+    if len(players) > limit:
+        output.append(mc_color_text(
+            f"... and {len(players) - limit} more players\n", "gray"))
+    for result in changes[index*limit:(index+1)*limit]:
+        output.append(mc_color_text(
+            f"{" ".join(map(str,result[0:3]))} ", "blue"))
+        output.append(mc_color_text(
+            f"{result[4]} {"placed" if result[3] == "p" else "broke"} ", "white"))
+        output.append(mc_color_text(
+            f"{result[8]} ", "aqua"))
+        output.append(mc_color_text(
+            f"{formatTimeAgo(result[7])} ago\n", "white"))
+    output.append(mc_color_text(
+        f"{side} << [Page {index+1} of {max(1, math.ceil(len(changes) / limit))}] >> {side}", "dark_aqua"))
+    return "[" + ",".join(output) + "]"
+
+def ledger_query(queryInput=None, pos=None, params=None, is_minecraft=False, page=0):
+    if (pos == None or params == None) and queryInput == None:
+        queryInput = input("Enter query:\n")
+    if pos == None or params == None:
+        (pos, params) = parse_query(queryInput)
+    (changes, players) = ledger(pos, params)
+    if is_minecraft:
+        print(show_ledger_mc(page, changes, players))
+    else:
+        show_ledger(page, changes, players)
+
 def parse_query(query):
     try:
         posInput, paramsInput = re.search( r'((?:-?\d+ ?){3})(.*)',query).groups()
@@ -361,74 +600,264 @@ def parse_query(query):
 
 # Main menu options
 # <x> <y> <z> <params>
-def query(queryInput=None, pos=None,params=None,is_minecraft=False,page=0):
-    if pos == None or params == None:
-        if queryInput == None:
-            queryInput = input("Enter query:\n")
-        posInput, paramsInput = parse_query(queryInput)
-        pos = tuple(posInput.split(" ", maxsplit=2)) if pos == None else pos
-        params = process_params(paramsInput) if params == None else params
-
-    print(pos)
-    print(params)
-    dbQuery = format_query(pos, params)
-    cursor.execute(f"SELECT COUNT(*) FROM ({dbQuery})")
-    total = cursor.fetchone()
+def lookup(queryInput=None, pos=None, params=None, page=0, token=None):
+    """Resolve a query string, parsed query or continuation token to (page, results, total, nextToken)"""
+    key, total = None, None
+    if token != None:
+        (pos, params, key, page, total) = decode_token(token)
+    elif pos == None or params == None:
+        (parsedPos, parsedParams) = parse_query(queryInput)
+        pos = parsedPos if pos == None else pos
+        params = parsedParams if params == None else params
+    (results, total, nextToken) = fetch_page(pos, params, page=page, key=key, total=total)
+    return (page, results, total, nextToken)
+
+def query(queryInput=None, pos=None,params=None,is_minecraft=False,page=0,token=None):
+    if token == None and (pos == None or params == None) and queryInput == None:
+        queryInput = input("Enter query:\n")
+    (page, results, total, nextToken) = lookup(queryInput, pos, params, page, token)
     if is_minecraft:
-        show_page_mc(page, dbQuery, total = total)
+        print(show_page_mc(page, results, total, nextToken))
     else:
-        show_page(page, dbQuery, total = total)
+        show_page(page, results, total, nextToken)
+
+# batch lookups, queries with overlapping bounding boxes are answered from one scan of their merged box
+def merge_boxes(boxes):
+    """Group the indexes of overlapping boxes, returns [(merged box, [index, ...]), ...]"""
+    groups = []
+    for index, box in enumerate(boxes):
+        group = (box, [index])
+        merged = True
+        while merged: # a grown box can overlap groups it did not overlap before
+            merged = False
+            for other in groups:
+                if all(low <= otherHigh and otherLow <= high for (low, high), (otherLow, otherHigh) in zip(group[0], other[0])):
+                    groups.remove(other)
+                    group = (tuple((min(low, otherLow), max(high, otherHigh)) for (low, high), (otherLow, otherHigh) in zip(group[0], other[0])), other[1] + group[1])
+                    merged = True
+                    break
+        groups.append(group)
+    return groups
+
+def row_filter(pos, params):
+    """compile_query's WHERE clause as a function of one (EVENT_COLUMNS, dimension, row_id) row, NULL compares as false like in SQL"""
+    (x, y, z) = map(int, pos)
+    radiusSquared = query_radius(params) ** 2
+    tables = query_tables(params)
+    checks = [(column, check["value"], check["negative"]) for name, column in (("action", 3), ("object", 8), ("source", 5)) for check in params[name]]
+    before = int(params["before"][0]["value"]) if len(params["before"]) > 0 else math.inf
+    after = int(params["after"][0]["value"]) if len(params["after"]) > 0 else -math.inf
+    def matches(row):
+        if (row[0] - x) ** 2 + (row[1] - y) ** 2 + (row[2] - z) ** 2 > radiusSquared or row[9] not in tables:
+            return False
+        for (column, value, negative) in checks:
+            if row[column] == None or (row[column] == value) == negative:
+                return False
+        return after <= row[7] <= before
+    return matches
+
+def scan_box(tables, box):
+    """Every row of `tables` inside `box`, as (EVENT_COLUMNS, dimension, row_id)"""
+    rows = []
+    ((minX, maxX), (minY, maxY), (minZ, maxZ)) = box
+    bindings = {"minX":minX, "maxX":maxX, "minY":minY, "maxY":maxY, "minZ":minZ, "maxZ":maxZ}
+    for dimension in tables:
+        for (table, number) in database.dimension_sources(cursor, dimension):
+            (source, rowid) = database.read_source(cursor, table)
+            if database.has_spatial_index(cursor, table):
+                where = database.box_filter(table, BOX_BINDINGS, rowid)
+            else:
+                where = "x BETWEEN :minX AND :maxX AND y BETWEEN :minY AND :maxY AND z BETWEEN :minZ AND :maxZ"
+            cursor.execute(f"SELECT {database.EVENT_COLUMNS}, '{dimension}' AS dimension, {database.partition_row_id(number, rowid)} AS row_id FROM {source} WHERE {where}", bindings)
+            rows += cursor.fetchall()
+    return rows
+
+def batch_lookup(lookups, limit=10):
+    """Answer [(pos, params, page), ...] like lookup(), scanning each group of overlapping bounding boxes once.
+    Returns [(page, results, total, nextToken), ...] in the same order"""
+    boxes = [database.sphere_box(pos, query_radius(params)) for (pos, params, page) in lookups]
+    answers = [None] * len(lookups)
+    for box, indexes in merge_boxes(boxes):
+        tables = [table for table in SQLITE3_DB_TABLES if any(table in query_tables(lookups[i][1]) for i in indexes)]
+        rows = sorted(scan_box(tables, box), key=lambda row: row[0]) # by x, so each query only checks the rows in its own x range
+        xs = [row[0] for row in rows]
+        for i in indexes:
+            (pos, params, page) = lookups[i]
+            ((minX, maxX), _, _) = boxes[i]
+            matching = list(filter(row_filter(pos, params), rows[bisect.bisect_left(xs, minX):bisect.bisect_right(xs, maxX)]))
+            matching.sort(key=lambda row: (row[7], row[9], row[10]), reverse=True)
+            results = matching[page * limit:(page+1) * limit]
+            nextToken = None
+            if len(results) == limit and (page+1) * limit < len(matching):
+                last = results[-1]
+                nextToken = encode_token(pos, params, [last[7], last[9], last[10]], page+1, len(matching))
+            answers[i] = (page, results, len(matching), nextToken)
+    return answers
+
+def result_json(result):
+    return {"x":result[0], "y":result[1], "z":result[2], "action":result[3], "username":result[4],
+        "time":result[7], "block":result[8], "dimension":result[9]}
+
+def run_batch(file, is_minecraft=False):
+    """Read one query per line (a query string, or {"query", "page"}) and print one json result line per query, in order"""
+    lookups = []
+    errors = {}
+    for i, line in enumerate(line for line in file if line.strip()):
+        try:
+            request = json.loads(line)
+            if isinstance(request, str):
+                request = {"query":request}
+            (pos, params) = parse_query(request["query"])
+            query_tables(params) # unknown worlds and players are an error of this line only
+            resolve_sources(params)
+            lookups.append((pos, params, int(request.get("page", 0))))
+        except (ValueError, KeyError, TypeError) as err:
+            errors[i] = error_text(err)
+            lookups.append(None)
+    answers = iter(batch_lookup([lookup for lookup in lookups if lookup != None]))
+    for i, lookup in enumerate(lookups):
+        if lookup == None:
+            print(("[" + mc_color_text(f"Error: {errors[i]}", "red") + "]").replace("\n", "\\n") if is_minecraft else json.dumps({"error":errors[i]}))
+            continue
+        (page, results, total, nextToken) = next(answers)
+        if is_minecraft:
+            print(show_page_mc(page, results, total, nextToken).replace("\n", "\\n")) # one line per query
+        else:
+            print(json.dumps({"page":page, "total":total, "next":nextToken, "results":[result_json(result) for result in results]}))
+
+# entries per (dimension, lower_username, interaction), from the rollup tables when every table has them
+# partitions keep their rollups under their own name, rollup_dimension() maps them back to their dimension
+def rollup_dimension():
+    partitions = database.partitions(cursor)
+    if len(partitions) == 0:
+        return "dimension"
+    return "CASE dimension " + " ".join(f"WHEN '{name}' THEN '{dimension}'" for (name, dimension, *_) in partitions) + " ELSE dimension END"
+
+def player_counts_source():
+    if all(database.has_rollups(cursor, table) for table in SQLITE3_DB_TABLES):
+        dimensions = ",".join(f"'{table}'" for table in event_tables())
+        return f"""SELECT {rollup_dimension()} AS dimension, lower_username, interaction, username, entries
+            FROM rollup_players WHERE dimension IN ({dimensions})"""
+    return " UNION ALL ".join(
+        [f"""SELECT '{dimension}' AS dimension, lower_username, interaction, MAX(username) AS username, COUNT(*) AS entries
+        FROM {database.read_source(cursor, table)[0]} GROUP BY lower_username, interaction"""
+        for dimension in SQLITE3_DB_TABLES for (table, number) in database.dimension_sources(cursor, dimension)]
+    )
+
+def player_counts(username):
+    """{interaction: entries} of a player, empty when the player is not in the database"""
+    cursor.execute(f"""SELECT interaction, SUM(entries)
+                   FROM ({player_counts_source()})
+                   WHERE lower_username=?
+                   GROUP BY interaction
+                   """, (username.lower(),))
+    return dict(cursor.fetchall())
+
+# player names, looked up in the player index (database.create_player_index) instead of the entries
+MAX_SUGGESTIONS = 5
+MAX_CANDIDATES = 200 # names that get compared to a misspelled one
+MAX_TRIGRAM_POSTINGS = 3000 # most names of the (rarest) trigrams a misspelled name is looked up by
+
+def has_player_index():
+    return all(database.has_player_index(cursor, table) for table in event_tables())
+
+def find_player(name):
+    """(lower_username, username) of the player called `name` in any case, None when there is none"""
+    cursor.execute("SELECT lower_username, username FROM player_names WHERE lower_username = ?", (name.lower(),))
+    return cursor.fetchone()
+
+def players_starting_with(prefix, limit=MAX_SUGGESTIONS):
+    """Names of the players whose name starts with `prefix` in any case, in alphabetical order"""
+    cursor.execute("""SELECT username FROM player_names
+        WHERE lower_username >= :prefix AND lower_username < :prefix || char(1114111)
+        ORDER BY lower_username LIMIT :limit""", {"prefix":prefix.lower(), "limit":limit})
+    return [row[0] for row in cursor.fetchall()]
+
+def similar_players(name, limit=MAX_SUGGESTIONS):
+    """Names of the players that are spelled the most like `name`, best first. The candidates are the names sharing the
+    rarest of its trigrams (player_search) and the names starting with its first two letters. Trigrams no name has are
+    the misspelled part, common ones match too many names to rank quickly. Without player_search every name is compared"""
+    name = name.lower()
+    candidates = {}
+    if database.has_table(cursor, "player_search"):
+        trigrams = list({name[i:i+3] for i in range(len(name) - 2)})
+        terms, postings = [], 0
+        if trigrams:
+            cursor.execute(f"SELECT term, doc FROM player_search_vocab WHERE term IN ({",".join("?" * len(trigrams))})", trigrams)
+            for (term, names) in sorted(cursor.fetchall(), key=lambda row: row[1]):
+                if terms and postings + names > MAX_TRIGRAM_POSTINGS:
+                    break
+                terms.append(term)
+                postings += names
+        if terms:
+            cursor.execute("""SELECT n.lower_username, n.username FROM player_search JOIN player_names n ON n.id = player_search.rowid
+                WHERE player_search MATCH ? ORDER BY rank LIMIT ?""", (" OR ".join('"' + term.replace('"', '""') + '"' for term in terms), MAX_CANDIDATES))
+            candidates = dict(cursor.fetchall())
+        cursor.execute("""SELECT lower_username, username FROM player_names
+            WHERE lower_username >= :prefix AND lower_username < :prefix || char(1114111) LIMIT :limit""", {"prefix":name[:2], "limit":MAX_CANDIDATES})
+        candidates.update(cursor.fetchall())
+    else:
+        cursor.execute("SELECT lower_username, username FROM player_names")
+        candidates = dict(cursor.fetchall())
+    return [candidates[match] for match in difflib.get_close_matches(name, candidates, limit)]
+
+def suggest_players(name, limit=MAX_SUGGESTIONS):
+    """Names `name` might have meant: the names it is the start of, then the similar ones"""
+    suggestions = players_starting_with(name, limit) if name else []
+    for similar in similar_players(name, limit):
+        if similar not in suggestions:
+            suggestions.append(similar)
+    return suggestions[:limit]
+
+def unknown_player(name):
+    """Message for a name that is not in the player index, with suggestions when there are any"""
+    suggestions = suggest_players(name)
+    if suggestions:
+        return f"Username '{name}' not found in database, did you mean {", ".join(suggestions)}?"
+    return f"Username '{name}' not found in database"
+
+def resolve_sources(params):
+    """Check the source: parameters of a lookup against the player index before any entries get read. A lookup for a
+    player that is not in the database is an error with suggestions instead of a scan for nothing"""
+    if not any(not check["negative"] for check in params["source"]) or not has_player_index():
+        return
+    for check in params["source"]:
+        if not check["negative"] and find_player(check["value"]) == None:
+            raise ValueError(unknown_player(check["value"]))
 
 def player():
     while True:
-        username = input("Input username: ")
-        cursor.execute(f"SELECT username FROM ({ALL_TABLES}) WHERE username='{username}'")
-        if len(cursor.fetchall()) > 0:
+        name = input("Input username: ")
+        if not has_player_index(): # every name gets looked up in the entries
+            counts = player_counts(name)
+            if len(counts) > 0:
+                break
+            print(f"{bcolors.WARNING}Username not found in database{bcolors.ENDC}")
+            continue
+        found = find_player(name)
+        if found != None:
+            counts = player_counts(found[0])
             break
-        print(f"{bcolors.WARNING}Username not found in database{bcolors.ENDC}")
+        print(f"{bcolors.WARNING}{unknown_player(name)}{bcolors.ENDC}")
     
     print("===[ PLAYER INFO ]===")
-    cursor.execute(f"""SELECT username, COUNT(*) AS value_count 
-                   FROM ({ALL_TABLES})
-                   WHERE username="{username}"
-                   GROUP BY username
-                   ORDER BY value_count DESC
-                   """) 
-    print(f"total occurences: {cursor.fetchone()[1]}")
-    cursor.execute(f"""SELECT username, COUNT(*) AS value_count 
-                   FROM ({ALL_TABLES})
-                   WHERE username=="{username}" AND interaction=="p"
-                   GROUP BY username
-                   ORDER BY value_count DESC
-                   """) 
-    print(f"blocks placed: {cursor.fetchone()[1]}")
-    cursor.execute(f"""SELECT username, COUNT(*) AS value_count 
-                   FROM ({ALL_TABLES})
-                   WHERE username=="{username}" AND interaction=="b"
-                   GROUP BY username
-                   ORDER BY value_count DESC
-                   """) 
-    print(f"blocks broken: {cursor.fetchone()[1]}")
-    cursor.execute(f"""SELECT username, COUNT(*) AS value_count 
-                   FROM ({ALL_TABLES})
-                   WHERE username=="{username}" AND interaction=="o"
-                   GROUP BY username
-                   ORDER BY value_count DESC
-                   """) 
-    print(f"containers opened: {cursor.fetchone()[1]}")
+    print(f"total occurences: {sum(counts.values())}")
+    print(f"blocks placed: {counts.get("p", 0)}")
+    print(f"blocks broken: {counts.get("b", 0)}")
+    print(f"containers opened: {counts.get("o", 0)}")
     
 def overview():
     print("===[ DATABASE OVERVIEW ]===")
+    playerCounts = player_counts_source()
 
     # username info
-    cursor.execute(f"""SELECT COUNT(DISTINCT x.username)
-        FROM (SELECT username FROM ({ALL_TABLES})) x""")
+    cursor.execute(f"SELECT COUNT(DISTINCT lower_username) FROM ({playerCounts})")
     usernames = cursor.fetchone()[0]
     print(f"distinct usernames: {usernames}")
 
-    cursor.execute(f"""SELECT username, COUNT(*) AS value_count 
-                   FROM ({ALL_TABLES})
-                   GROUP BY username 
+    cursor.execute(f"""SELECT MAX(username), SUM(entries) AS value_count 
+                   FROM ({playerCounts})
+                   GROUP BY lower_username 
                    ORDER BY value_count DESC
                    LIMIT 3
                    """)
@@ -438,54 +867,348 @@ def overview():
         print(f"{char} {table_entry[0]}: {table_entry[1]}")
     
     # dimension/table info
-    cursor.execute(f"SELECT COUNT(*) FROM ({ALL_TABLES})")
-    totalEntries = cursor.fetchone()[0]
-    print(f"total entries: {totalEntries}")
-
-    sql_query = " UNION ALL ".join(
-        [f"SELECT '{table}' AS dimension, COUNT(*) AS entries FROM {table}" for table in SQLITE3_DB_TABLES]
-    )
-    cursor.execute(f"""SELECT dimension, entries
-        FROM (
-            {sql_query}
-        ) AS combined
+    cursor.execute(f"""SELECT dimension, SUM(entries) AS entries
+        FROM ({playerCounts})
+        GROUP BY dimension
         ORDER BY entries DESC
-        LIMIT 4;
     """)
     table_entries = cursor.fetchall()
+    totalEntries = sum(entries for (dimension, entries) in table_entries)
+    print(f"total entries: {totalEntries}")
+    table_entries = table_entries[:4]
     for i, table_entry in enumerate(table_entries):
         char = "└" if i+1 == len(table_entries) else "├"
         print(f"{char} {table_entry[0]}: {table_entry[1]}")
-    
+
+    # recent activity, only kept in the rollups
+    if database.has_table(cursor, "rollup_days"):
+        dimensions = ",".join(f"'{table}'" for table in event_tables())
+        cursor.execute(f"""SELECT COALESCE(SUM(entries), 0) FROM rollup_days
+            WHERE dimension IN ({dimensions}) AND day >= {round(time.time()) // 86400 - 7}""")
+        print(f"entries last 7 days: {cursor.fetchone()[0]}")
+
+# activity heatmap of chunks or regions, read from the heatmap tables only (never the event tables). These count per
+# UTC day, so after:/before: include the whole first and last day of their window
+MAX_HEATMAP_TILES = 250000
+
+def heatmap_window(params, level):
+    """(WHERE clause on the heatmap_tiles/heatmap_players rows of a tile size and time window, bindings,
+    {dimension: [table, ...]}) of the world:, before: and after: parameters"""
+    for name in ("object", "source", "range"):
+        if len(params[name]) > 0:
+            raise ValueError(f"Parameter '{name}' can not be used for heatmaps, only world:, action:, before: and after:")
+    (after, before) = query_window(params)
+    sources = {dimension: [table for (table, number) in database.dimension_sources(cursor, dimension, after, before)] for dimension in query_tables(params)}
+    if not all(database.has_heatmap(cursor, table) for tables in sources.values() for table in tables):
+        raise ValueError("Not every table has a heatmap, create them with 'query.py --rebuild-heatmap'")
+    checks = ["level = :level", "entries > 0"]
+    bindings = {"level":level}
+    if after != None:
+        checks.append("day >= :firstDay")
+        bindings["firstDay"] = after // 86400
+    if before != None:
+        checks.append("day <= :lastDay")
+        bindings["lastDay"] = before // 86400
+    return (" AND ".join(checks), bindings, sources)
+
+def heatmap_tables(tables):
+    return f"dimension IN ({",".join(f"'{table}'" for table in tables)})"
+
+def heatmap_actions(params, bindings):
+    """WHERE clause of the action: parameters on heatmap_tiles, their values go into `bindings`"""
+    checks = []
+    for i, check in enumerate(params["action"]):
+        checks.append(f" AND interaction {"!" if check["negative"] else "="}= :action{i}")
+        bindings[f"action{i}"] = check["value"]
+    return "".join(checks)
+
+def hotspots(params, level=database.HEATMAP_LEVELS["chunk"], limit=10):
+    """The `limit` tiles with the most entries, [(dimension, tile_x, tile_z, entries, {interaction: entries}, players, last time)].
+    players counts everyone active in the tile within the window, whatever their action"""
+    (where, bindings, sources) = heatmap_window(params, level)
+    actions = heatmap_actions(params, bindings)
+    tables = [table for dimensionTables in sources.values() for table in dimensionTables]
+    cursor.execute(f"""SELECT {rollup_dimension()} AS world, tile_x, tile_z, SUM(entries) AS total, MAX(last_time)
+        FROM heatmap_tiles WHERE {heatmap_tables(tables)} AND {where}{actions}
+        GROUP BY world, tile_x, tile_z
+        ORDER BY total DESC, world, tile_x, tile_z
+        LIMIT :limit""", {**bindings, "limit":limit})
+    tiles = cursor.fetchall()
+    if len(tiles) == 0:
+        return []
+    # the entries per interaction of only these tiles, breaking every tile down makes the grouping above a lot slower
+    tileBindings = {}
+    for i, (dimension, tileX, tileZ, entries, lastTime) in enumerate(tiles):
+        tileBindings.update({f"tileX{i}":tileX, f"tileZ{i}":tileZ})
+    cursor.execute(f"""SELECT {rollup_dimension()} AS world, tile_x, tile_z, interaction, SUM(entries)
+        FROM heatmap_tiles WHERE {heatmap_tables(tables)} AND {where}{actions}
+            AND (tile_x, tile_z) IN (VALUES {",".join(f"(:tileX{i}, :tileZ{i})" for i in range(len(tiles)))})
+        GROUP BY world, tile_x, tile_z, interaction""", {**bindings, **tileBindings})
+    interactions = {}
+    for (dimension, tileX, tileZ, interaction, entries) in cursor.fetchall():
+        interactions.setdefault((dimension, tileX, tileZ), {})[interaction] = entries
+    results = []
+    for (dimension, tileX, tileZ, entries, lastTime) in tiles:
+        cursor.execute(f"""SELECT COUNT(DISTINCT lower_username) FROM heatmap_players
+            WHERE {heatmap_tables(sources[dimension])} AND tile_x = :tileX AND tile_z = :tileZ AND {where}""",
+            {**bindings, "tileX":tileX, "tileZ":tileZ})
+        results.append((dimension, tileX, tileZ, entries, interactions[(dimension, tileX, tileZ)], cursor.fetchone()[0], lastTime))
+    return results
+
+def heatmap_grid(params, box, level=database.HEATMAP_LEVELS["chunk"]):
+    """Entries per tile of the block area `box` (x1, z1, x2, z2) of one world, ((first tile_x, first tile_z), grid)
+    with a row per tile_z (north first) of the entries per tile_x (west first)"""
+    (where, bindings, sources) = heatmap_window(params, level)
+    if len(sources) != 1:
+        raise ValueError("A heatmap grid shows one world, add a world: parameter")
+    actions = heatmap_actions(params, bindings)
+    (x1, z1, x2, z2) = box
+    (minTileX, maxTileX) = (min(x1, x2) >> level, max(x1, x2) >> level)
+    (minTileZ, maxTileZ) = (min(z1, z2) >> level, max(z1, z2) >> level)
+    if (maxTileX - minTileX + 1) * (maxTileZ - minTileZ + 1) > MAX_HEATMAP_TILES:
+        raise ValueError(f"The area has more than {MAX_HEATMAP_TILES} tiles, make it smaller or use bigger tiles")
+    cursor.execute(f"""SELECT tile_x, tile_z, SUM(entries) FROM heatmap_tiles
+        WHERE {heatmap_tables(list(sources.values())[0])} AND {where}{actions}
+            AND tile_x BETWEEN :minTileX AND :maxTileX AND tile_z BETWEEN :minTileZ AND :maxTileZ
+        GROUP BY tile_x, tile_z""", {**bindings, "minTileX":minTileX, "maxTileX":maxTileX, "minTileZ":minTileZ, "maxTileZ":maxTileZ})
+    grid = [[0] * (maxTileX - minTileX + 1) for _ in range(maxTileZ - minTileZ + 1)]
+    for (tileX, tileZ, entries) in cursor.fetchall():
+        grid[tileZ - minTileZ][tileX - minTileX] = entries
+    return ((minTileX, minTileZ), grid)
+
+def heat_level(entries, maxEntries, levels):
+    """0 for no entries, otherwise 1 to levels - 1 on a log scale up to `maxEntries`"""
+    if entries == 0:
+        return 0
+    return 1 + round(math.log(entries) / math.log(max(maxEntries, 2)) * (levels - 2))
+
+def show_hotspots(tiles, level):
+    sideWidth = 15
+    side = "="*sideWidth
+    size = 1 << level
+    interactionNames = {"p":"placed", "b":"broken", "o":"opened"}
+    print(f"{bcolors.CYAN}{side} Hotspots ({size}x{size}) {side}{bcolors.ENDC}")
+    for i, (dimension, tileX, tileZ, entries, interactions, players, lastTime) in enumerate(tiles):
+        print(f"{i+1}. {bcolors.BLUE}{dimension} x {tileX * size}..{tileX * size + size - 1} z {tileZ * size}..{tileZ * size + size - 1}{bcolors.ENDC}: "
+            f"{entries} entries by {players} players, last {formatTimeAgo(lastTime)} ago")
+        print("   " + ", ".join(f"{interactionNames.get(interaction, interaction)} {count}" for interaction, count in sorted(interactions.items(), key=lambda item: -item[1])))
+    if len(tiles) == 0:
+        print("no entries")
+
+def show_hotspots_mc(tiles, level):
+    sideWidth = 15
+    side = "="*sideWidth
+    size = 1 << level
+    output = []
+    output.append(mc_color_text(
+        f"{side} Hotspots ({size}x{size}) {side}\n", "dark_aqua"))
+    for i, (dimension, tileX, tileZ, entries, interactions, players, lastTime) in enumerate(tiles):
+        output.append(mc_color_text(
+            f"{i+1}. {dimension} {tileX * size + size // 2} ~ {tileZ * size + size // 2} ", "blue"))
+        output.append(mc_color_text(
+            f"{entries} entries by {players} players, last {formatTimeAgo(lastTime)} ago\n", "white"))
+    if len(tiles) == 0:
+        output.append(mc_color_text(
+            "no entries\n", "white"))
+    output.append(mc_color_text(
+        f"{side}{side}", "dark_aqua"))
+    return "[" + ",".join(output) + "]"
+
+def show_heatmap(origin, grid, level):
+    shades = " ░▒▓█"
+    size = 1 << level
+    maxEntries = max(max(row) for row in grid)
+    print(f"{bcolors.CYAN}Heatmap from x {origin[0] * size} z {origin[1] * size}, {size}x{size} blocks per character, north up{bcolors.ENDC}")
+    for row in grid:
+        print("".join(shades[heat_level(entries, maxEntries, len(shades))] for entries in row))
+    print(f"{bcolors.CYAN}{shades[-1]} = {maxEntries} entries{bcolors.ENDC}")
+
+def show_heatmap_mc(origin, grid, level):
+    colors = ["dark_gray", "dark_green", "green", "yellow", "gold", "red"]
+    size = 1 << level
+    maxEntries = max(max(row) for row in grid)
+    output = []
+    output.append(mc_color_text(
+        f"Heatmap from {origin[0] * size} {origin[1] * size}, {size}x{size} blocks per square\n", "dark_aqua"))
+    for row in grid:
+        for entries in row:
+            output.append(mc_color_text("■", colors[heat_level(entries, maxEntries, len(colors))]))
+        output.append(mc_color_text("\n", "white"))
+    output.append(mc_color_text(
+        f"red = {maxEntries} entries", "dark_aqua"))
+    return "[" + ",".join(output) + "]"
+
+
+# query daemon, keeps the connection (and its page and statement cache) warm between minecraft lookups
+serveLatencies = deque(maxlen=10000) # ms, most recent requests
+serveStats = {"requests":0,"errors":0}
+serveStatsLock = threading.Lock() # requests are answered on a thread per client
+
+def latency_stats():
+    with serveStatsLock:
+        latencies = sorted(serveLatencies)
+        stats = dict(serveStats)
+    def percentile(p):
+        return round(latencies[min(len(latencies)-1, int(len(latencies) * p))], 2) if latencies else None
+    return {**stats, "p50_ms":percentile(0.5), "p99_ms":percentile(0.99), "max_ms":percentile(1), "cache":resultCache.summary()}
+
+def answer_request(request):
+    """Answer one daemon request ({"query", "page"}, {"token"} or {"query", "page", "ledger":true}) with show_page_mc json"""
+    if isinstance(request, str): # a bare query string, like in --batch files
+        request = {"query":request}
+    if not isinstance(request, dict):
+        raise ValueError("A request is a query string or a json object")
+    if request.get("stats"):
+        return json.dumps(latency_stats())
+    if request.get("ledger"):
+        (pos, params) = parse_query(request["query"])
+        return show_ledger_mc(int(request.get("page", 0)), *ledger(pos, params))
+    (page, results, total, nextToken) = lookup(request.get("query"), page=int(request.get("page", 0)), token=request.get("token"))
+    return show_page_mc(page, results, total, nextToken)
+
+class QueryRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile: # one json request per line, one response line each
+            start = time.perf_counter()
+            try:
+                response = answer_request(json.loads(line))
+            except (ValueError, KeyError, TypeError, sqlite3.Error) as err:
+                with serveStatsLock:
+                    serveStats["errors"] += 1
+                response = "[" + mc_color_text(f"Error: {error_text(err)}", "red") + "]"
+            finally:
+                readPool.release() # other clients can use the connection while this one is idle
+            self.wfile.write(response.replace("\n", "\\n").encode() + b"\n")
+            elapsed = (time.perf_counter() - start) * 1000
+            with serveStatsLock:
+                serveStats["requests"] += 1
+                serveLatencies.append(elapsed)
+            if LOG_EVERY:
+                print(f"{elapsed:.1f}ms {line.decode().strip()}")
+
+def serve(address):
+    family, target = query_client.parse_address(address)
+    # clients connect per request, allow more than the default 5 waiting connections
+    socketserver.ThreadingUnixStreamServer.request_queue_size = 64
+    socketserver.ThreadingTCPServer.request_queue_size = 64
+    if family == socket.AF_UNIX:
+        if os.path.exists(target):
+            os.remove(target)
+        server = socketserver.ThreadingUnixStreamServer(target, QueryRequestHandler)
+    else:
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer(target, QueryRequestHandler)
+    server.daemon_threads = True # a client that stays connected does not keep the daemon from stopping
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    print(f"{bcolors.OKGREEN}Serving queries on {address}{bcolors.ENDC}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"served {json.dumps(latency_stats())}")
+
+# canonical lookups, used to show what the indexes do
+def canonical_queries():
+    """The common access paths over every event table (with the partitions, whose base tables stay empty), as a union
+    with the filter, ORDER BY and LIMIT in every branch like compile_query"""
+    sources = [database.read_source(cursor, table)[0] for table in event_tables()]
+    def union(branch):
+        return " UNION ALL ".join(f"SELECT * FROM ({branch.format(table=source)})" for source in sources)
+    return [
+        ("player", f"SELECT SUM(entries) FROM ({union("SELECT COUNT(*) AS entries FROM {table} WHERE lower_username='steve' AND interaction='b'")})"),
+        ("source + after", f"{union("SELECT * FROM {table} WHERE lower_username='steve' AND UNIX_time >= 0")} ORDER BY UNIX_time desc"),
+        ("before/after", f"{union("SELECT * FROM {table} WHERE UNIX_time <= 1 AND UNIX_time >= 0 ORDER BY UNIX_time desc LIMIT 10")} ORDER BY UNIX_time desc LIMIT 10"),
+        ("object", f"{union("SELECT * FROM {table} WHERE block='minecraft:tnt'")} ORDER BY UNIX_time desc"),
+        ("overview", f"SELECT lower_username, SUM(entries) FROM ({union("SELECT lower_username, COUNT(*) AS entries FROM {table} GROUP BY lower_username")}) GROUP BY lower_username"),
+    ]
+
+def show_query_plans(title):
+    print(f"{bcolors.HEADER}===[ QUERY PLANS {title} ]==={bcolors.ENDC}")
+    for name, sql in canonical_queries():
+        print(f"{bcolors.BOLD}{name}{bcolors.ENDC}")
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+        for row in cursor.fetchall():
+            print(f"  {row[3]}")
+
+def time_canonical_queries(repeat=3):
+    timings = {}
+    for name, sql in canonical_queries():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cursor.execute(sql)
+            cursor.fetchall()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best == None else min(best, elapsed)
+        timings[name] = best
+    return timings
+
+def database_size():
+    cursor.execute("PRAGMA page_count")
+    pages = cursor.fetchone()[0]
+    cursor.execute("PRAGMA page_size")
+    return pages * cursor.fetchone()[0]
+
+def migrate_compact():
+    """Migrate every table to the compact (dictionary encoded) layout and report the size and speed change"""
+    sizeBefore = database_size()
+    timingsBefore = time_canonical_queries()
+    for table in event_tables():
+        start = time.perf_counter()
+        migrated = database.migrate_to_compact(cursor, table)
+        conn.commit()
+        print(f"{bcolors.OKGREEN}Migrated {migrated} entries of '{table}' in {time.perf_counter() - start:.2f}s{bcolors.ENDC}")
+    cursor.execute("VACUUM")
+    sizeAfter = database_size()
+    timingsAfter = time_canonical_queries()
+    print(f"database size: {sizeBefore / 2**20:.1f}MiB -> {sizeAfter / 2**20:.1f}MiB ({(sizeAfter - sizeBefore) / max(sizeBefore, 1) * 100:+.0f}%)")
+    for name in timingsBefore:
+        print(f"{name}: {timingsBefore[name] * 1000:.2f}ms -> {timingsAfter[name] * 1000:.2f}ms")
 
 def main():
 
-    (choice, option) = option_menu(["query","player","overview","exit"],name="QUERY DATABASE",offset=1)
+    (choice, option) = option_menu(["query","ledger","player","overview","exit"],name="QUERY DATABASE",offset=1)
     
     match choice:
         case 1:
             query()
         case 2:
-            player()
+            ledger_query()
         case 3:
-            overview()
+            player()
         case 4:
+            overview()
+        case 5:
             exit_prgm()
 
 if __name__ == "__main__":
     def check_query(option, opt, value):
         try:
             queryData = parse_query(value)
+            resolve_sources(queryData[1])
             return queryData
         except ValueError as err:
             raise optparse.OptionValueError(
                 f"option {opt}: {err}"
             ) from err
 
+    def check_params(option, opt, value):
+        try:
+            return process_params(value)
+        except (ValueError, KeyError) as err:
+            raise optparse.OptionValueError(
+                f"option {opt}: {err}"
+            ) from err
+
     class CustomOptionTypes(optparse.Option):
-        TYPES = optparse.Option.TYPES + ("query",)
+        TYPES = optparse.Option.TYPES + ("query", "params")
         TYPE_CHECKER = copy(optparse.Option.TYPE_CHECKER)
         TYPE_CHECKER["query"] = check_query
+        TYPE_CHECKER["params"] = check_params
     
     parser = optparse.OptionParser(option_class=CustomOptionTypes)
 
@@ -498,10 +1221,205 @@ if __name__ == "__main__":
     parser.add_option('-p','--page',dest='page',
         default=0,type="int",
         help='Query page to show')
+    parser.add_option('-c','--continue',dest='token',
+        help='Continue with the page after the one that printed this continuation token')
+    parser.add_option('--ledger', dest='ledger',
+        action='store_true',default=False,
+        help='Show the net result of the --query area instead of its entries: the latest block change of every position and the placed/broken count of every player')
+    parser.add_option('--hotspots', dest='hotspots',
+        type="int",
+        help='Show the N tiles with the most entries, from the heatmap tables (use --where for the worlds, actions and time window)')
+    parser.add_option('--heatmap', dest='heatmap',
+        type="int", nargs=4, metavar="X1 Z1 X2 Z2",
+        help='Show the entries per tile of a block area of one world as a grid, from the heatmap tables (use --where for the world, actions and time window)')
+    parser.add_option('--tile', dest='tile',
+        type="choice", choices=list(database.HEATMAP_LEVELS), default="chunk",
+        help='Tile size of --hotspots and --heatmap: chunk (16x16 blocks, default) or region (512x512 blocks)')
+    parser.add_option('--where', dest='where',
+        type="params", default="",
+        help='Parameters of --hotspots and --heatmap, like "world:overworld action:block-break after:7d" (only world:, action:, before: and after:)')
+    parser.add_option('--batch', dest='batch',
+        help='Answer a file of queries, one per line as a json string or {"query", "page"} object ("-" reads stdin), with one json result per line (show_page_mc json with -m)')
+    parser.add_option('--serve', dest='serve',
+        action='store_true',default=False,
+        help='Run as a query daemon for query_client.py (minecraft json output)')
+    parser.add_option('--address', dest='address',
+        default=os.getenv('QUERY_SERVER_ADDRESS') or query_client.DEFAULT_ADDRESS,
+        help='Address for --serve (host:port or unix:/path)')
+    parser.add_option('--build-spatial-index', dest='build_spatial_index',
+        action='store_true',default=False,
+        help='Create (or rebuild) the spatial index of every table and backfill it with the existing entries')
     
+    parser.add_option('--rebuild-rollups', dest='rebuild_rollups',
+        action='store_true',default=False,
+        help='Create or recompute the player/day rollup tables of every table (repairs drift)')
+    parser.add_option('--rebuild-heatmap', dest='rebuild_heatmap',
+        action='store_true',default=False,
+        help='Create or recompute the chunk/region heatmap tables of every table (repairs drift)')
+    parser.add_option('--rebuild-players', dest='rebuild_players',
+        action='store_true',default=False,
+        help='Create or recompute the player name index (prefix and did-you-mean lookups of names) from every table')
+    parser.add_option('--migrate-compact', dest='migrate_compact',
+        action='store_true',default=False,
+        help='Rewrite every table to the compact (dictionary encoded) layout and report the size and speed change')
+    parser.add_option('--build-indexes', dest='build_indexes',
+        action='store_true',default=False,
+        help='Create the secondary (user, time, block) indexes on every table and ANALYZE')
+    parser.add_option('--drop-indexes', dest='drop_indexes',
+        action='store_true',default=False,
+        help='Drop the secondary indexes of every table')
+    parser.add_option('--engine', dest='engine',
+        type="choice", choices=["sql", "snapshot"], default="sql",
+        help='Answer lookups with SQLite (sql) or the columnar snapshot of --export-snapshot (snapshot, needs numpy), the snapshot is only used while no entries got added after exporting it')
+    parser.add_option('--export-snapshot', dest='export_snapshot',
+        action='store_true',default=False,
+        help='Write every table to the columnar snapshot in SNAPSHOT_DIR (needs numpy)')
+    parser.add_option('--partitions', dest='partitions',
+        action='store_true',default=False,
+        help='List the monthly partitions (PARTITION_MONTHLY) with their entry count')
+    parser.add_option('--drop-partitions-before', dest='drop_partitions_before',
+        help='Delete the monthly partitions of the months before YYYY-MM, with all their entries')
     opts, args = parser.parse_args()
 
-    if opts.query != None:
+    if opts.export_snapshot:
+        start = time.perf_counter()
+        counts = snapshot.export(cursor, SQLITE3_DB_TABLES, SNAPSHOT_DIR, database.read_generation(cursor))
+        for dimension, rows in counts.items():
+            print(f"{dimension}: {rows} entries")
+        print(f"{bcolors.OKGREEN}Exported {sum(counts.values())} entries to '{SNAPSHOT_DIR}' in {time.perf_counter() - start:.2f}s{bcolors.ENDC}")
+        exit_prgm()
+
+    if opts.engine == "snapshot":
+        try:
+            snapshotEngine = snapshot.Snapshot(SNAPSHOT_DIR)
+        except FileNotFoundError:
+            parser.error(f"option --engine: there is no snapshot in '{SNAPSHOT_DIR}', create it with --export-snapshot")
+        except RuntimeError as err:
+            parser.error(f"option --engine: {err}")
+        if snapshotEngine.generation != database.read_generation(cursor):
+            print(f"{bcolors.WARNING}The snapshot in '{SNAPSHOT_DIR}' is older than the database, using SQL until it is exported again (query.py --export-snapshot){bcolors.ENDC}", file=sys.stderr)
+
+    if opts.drop_partitions_before != None or opts.migrate_compact or opts.rebuild_rollups or opts.rebuild_heatmap or opts.rebuild_players or opts.build_indexes or opts.drop_indexes or opts.build_spatial_index:
+        cursor = conn.cursor() # these write
+
+    if opts.partitions:
+        for (name, dimension, number, start, end) in database.partitions(cursor):
+            cursor.execute(f'SELECT COUNT(*) FROM "{name}"')
+            print(f"{name}: {dimension} {datetime.datetime.fromtimestamp(start, datetime.UTC).strftime("%Y-%m")}, {cursor.fetchone()[0]} entries")
+        exit_prgm()
+
+    if opts.drop_partitions_before != None:
+        try:
+            before = datetime.datetime.strptime(opts.drop_partitions_before, "%Y-%m").replace(tzinfo=datetime.UTC).timestamp()
+        except ValueError:
+            parser.error(f"option --drop-partitions-before: '{opts.drop_partitions_before}' is not YYYY-MM")
+        for (name, dimension, number, start, end) in database.partitions(cursor, before=before):
+            if end > before: # only whole months
+                continue
+            entries = database.drop_partition(cursor, name)
+            conn.commit()
+            print(f"{bcolors.OKGREEN}Dropped '{name}' with {entries} entries{bcolors.ENDC}")
+        exit_prgm()
+
+    if opts.migrate_compact:
+        migrate_compact()
+        exit_prgm()
+
+    if opts.rebuild_rollups:
+        for table in event_tables():
+            start = time.perf_counter()
+            entries = database.create_rollups(cursor, table)
+            conn.commit()
+            print(f"{bcolors.OKGREEN}Rolled up {entries} entries of '{table}' in {time.perf_counter() - start:.2f}s{bcolors.ENDC}")
+        exit_prgm()
+
+    if opts.rebuild_heatmap:
+        for table in event_tables():
+            start = time.perf_counter()
+            tiles = database.create_heatmap(cursor, table)
+            conn.commit()
+            print(f"{bcolors.OKGREEN}Mapped '{table}' to {tiles} tiles in {time.perf_counter() - start:.2f}s{bcolors.ENDC}")
+        exit_prgm()
+
+    if opts.rebuild_players:
+        database.clear_player_index(cursor)
+        for table in event_tables():
+            start = time.perf_counter()
+            names = database.create_player_index(cursor, table)
+            conn.commit()
+            print(f"{bcolors.OKGREEN}Indexed {names} new player names of '{table}' in {time.perf_counter() - start:.2f}s{bcolors.ENDC}")
+        exit_prgm()
+
+    if opts.build_indexes or opts.drop_indexes:
+        show_query_plans("BEFORE")
+        start = time.perf_counter()
+        for table in event_tables():
+            if opts.build_indexes:
+                database.create_secondary_indexes(cursor, table)
+            else:
+                database.drop_secondary_indexes(cursor, table)
+        conn.commit()
+        if opts.build_indexes:
+            cursor.execute("ANALYZE")
+            conn.commit()
+        print(f"{bcolors.OKGREEN}{"Built" if opts.build_indexes else "Dropped"} indexes in {time.perf_counter() - start:.2f}s{bcolors.ENDC}")
+        show_query_plans("AFTER")
+        exit_prgm()
+
+    if opts.build_spatial_index:
+        for table in event_tables():
+            start = time.perf_counter()
+            indexed = database.create_spatial_index(cursor, table)
+            conn.commit()
+            print(f"{bcolors.OKGREEN}Indexed {indexed} entries of '{table}' in {time.perf_counter() - start:.2f}s{bcolors.ENDC}")
+        exit_prgm()
+
+    if opts.serve:
+        serve(opts.address)
+        exit_prgm()
+
+    if opts.hotspots != None or opts.heatmap != None:
+        level = database.HEATMAP_LEVELS[opts.tile]
+        try:
+            if opts.hotspots != None:
+                tiles = hotspots(opts.where, level, opts.hotspots)
+                if opts.is_minecraft:
+                    print(show_hotspots_mc(tiles, level))
+                else:
+                    show_hotspots(tiles, level)
+            else:
+                (origin, grid) = heatmap_grid(opts.where, opts.heatmap, level)
+                if opts.is_minecraft:
+                    print(show_heatmap_mc(origin, grid, level))
+                else:
+                    show_heatmap(origin, grid, level)
+        except ValueError as err:
+            parser.error(str(err))
+        conn.close()
+        sys.exit(0)
+
+    if opts.batch != None:
+        if opts.batch == "-":
+            run_batch(sys.stdin, is_minecraft = opts.is_minecraft)
+        else:
+            with open(opts.batch, "r") as file:
+                run_batch(file, is_minecraft = opts.is_minecraft)
+        conn.close()
+        sys.exit(0)
+
+    if opts.token != None:
+        try:
+            query(token = opts.token, is_minecraft = opts.is_minecraft)
+        except ValueError as err:
+            parser.error(str(err))
+    elif opts.query != None and opts.ledger:
+        ledger_query(
+            pos = opts.query[0],
+            params = opts.query[1],
+            is_minecraft = opts.is_minecraft,
+            page = opts.page if opts.page != None else 0
+            )
+    elif opts.query != None:
         query(
             pos = opts.query[0],
             params = opts.query[1],
@@ -0,0 +1,63 @@
+import optparse, socket, json, os, sys
+from dotenv import load_dotenv
+
+# thin client for 'query.py --serve', prints the same minecraft json as 'query.py -m'
+# (no database connection, no env checks, so this is what minecraft should call)
+
+load_dotenv()
+DEFAULT_ADDRESS = "127.0.0.1:25580"
+
+def parse_address(address):
+    """'host:port' for tcp, 'unix:/path' or anything with a '/' for a unix socket"""
+    if address.startswith("unix:"):
+        return (socket.AF_UNIX, address[5:])
+    if "/" in address:
+        return (socket.AF_UNIX, address)
+    host, port = address.rsplit(":", maxsplit=1)
+    return (socket.AF_INET, (host, int(port)))
+
+def send_request(address, request, timeout=10):
+    """Send one request to the query daemon and return its one line response"""
+    family, target = parse_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(target)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as response:
+            return response.readline().decode().rstrip("\n")
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option('-q','--query', dest="query",
+        help='Query to run, same syntax as query.py -q')
+    parser.add_option('-p','--page',dest='page',
+        default=0,type="int",
+        help='Query page to show')
+    parser.add_option('-c','--continue',dest='token',
+        help='Continue with the page after the one that printed this continuation token')
+    parser.add_option('--ledger', dest='ledger',
+        action='store_true',default=False,
+        help='Ask for the net result of the -q area (query.py --ledger)')
+    parser.add_option('--stats', dest='stats',
+        action='store_true',default=False,
+        help='Print the latency statistics of the daemon')
+    parser.add_option('--address', dest='address',
+        default=os.getenv('QUERY_SERVER_ADDRESS') or DEFAULT_ADDRESS,
+        help='Address of the query daemon (host:port or unix:/path)')
+    opts, args = parser.parse_args()
+
+    if opts.stats:
+        request = {"stats":True}
+    elif opts.token != None:
+        request = {"token":opts.token}
+    elif opts.query != None:
+        request = {"query":opts.query,"page":opts.page,"ledger":opts.ledger}
+    else:
+        parser.error("one of -q, -c or --stats is required")
+
+    try:
+        response = send_request(opts.address, request)
+    except OSError as err:
+        print(f"Could not reach the query daemon at {opts.address}: {err}", file=sys.stderr)
+        sys.exit(1)
+    print(response)
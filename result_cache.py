@@ -0,0 +1,87 @@
+import sqlite3, json, time, threading
+from collections import OrderedDict
+
+# query.py result cache: the total and the first result keys of a normalized query, in memory (LRU) and optionally in an
+# sqlite file so one shot 'query.py -m' processes share it. Everything cached belongs to one ingest generation
+# (database.read_generation()), main.py bumps it whenever it commits entries so seeing another generation starts over.
+# Safe to share between the threads of query.py --serve
+
+class ResultCache:
+    def __init__(self, maxEntries=256, path=None, maxDiskEntries=4096):
+        self.maxEntries = maxEntries
+        self.maxDiskEntries = maxDiskEntries
+        self.entries = OrderedDict() # key: value, least recently used first
+        self.generation = None
+        self.stats = {"hits":0, "disk_hits":0, "misses":0, "evictions":0, "invalidations":0}
+        self.lock = threading.RLock()
+        self.disk = None
+        if path:
+            self.disk = sqlite3.connect(path, timeout=5, check_same_thread=False)
+            self.disk.execute("""CREATE TABLE if not exists result_cache (
+                `key` TEXT PRIMARY KEY,
+                `generation` INTEGER NOT NULL,
+                `value` TEXT NOT NULL,
+                `used` REAL NOT NULL)
+                """)
+            self.disk.commit()
+
+    def set_generation(self, generation):
+        """Forget everything cached for another ingest generation"""
+        with self.lock:
+            if generation == self.generation:
+                return
+            if self.generation != None:
+                self.stats["invalidations"] += 1
+            self.generation = generation
+            self.entries.clear()
+            if self.disk:
+                self.disk.execute("DELETE FROM result_cache WHERE generation != ?", (generation,))
+                self.disk.commit()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.entries[key]
+            if self.disk:
+                row = self.disk.execute("SELECT value FROM result_cache WHERE key=? AND generation=?", (key, self.generation)).fetchone()
+                if row != None:
+                    self.disk.execute("UPDATE result_cache SET used=? WHERE key=?", (time.time(), key))
+                    self.disk.commit()
+                    self.stats["disk_hits"] += 1
+                    value = json.loads(row[0])
+                    self.remember(key, value)
+                    return value
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, value, generation=None):
+        """Cache `value`, unless it was looked up at another `generation` than the current one"""
+        with self.lock:
+            if generation != None and generation != self.generation:
+                return
+            self.remember(key, value)
+            if self.disk:
+                self.disk.execute("INSERT OR REPLACE INTO result_cache VALUES (?, ?, ?, ?)", (key, self.generation, json.dumps(value), time.time()))
+                self.disk.execute("DELETE FROM result_cache WHERE key IN (SELECT key FROM result_cache ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.maxDiskEntries,))
+                self.disk.commit()
+
+    def remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        """Empty the memory tier"""
+        with self.lock:
+            self.entries.clear()
+
+    def summary(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["misses"]
+            return {**self.stats, "entries":len(self.entries), "generation":self.generation,
+                "hit_rate":round((self.stats["hits"] + self.stats["disk_hits"]) / lookups, 3) if lookups else None}
@@ -0,0 +1,143 @@
+import os, json, time
+import database
+try:
+    import numpy
+except ImportError: # optional, only needed for query.py --export-snapshot and --engine snapshot
+    numpy = None
+
+# columnar snapshot of the event tables for lookups over huge areas or time windows: a directory per dimension with one
+# .npy file per column, memory mapped and filtered with vectorized masks instead of going through SQLite row by row.
+# Rows are sorted newest first so before:/after: are a slice, usernames/blocks/interactions/UUIDs are dictionary coded.
+# A snapshot belongs to the ingest generation it was exported at (database.read_generation()), query.py only uses it
+# while the database is still at that generation
+
+COLUMNS = {"x":"int32", "y":"int32", "z":"int32", "time":"int64", "row_id":"int64", "interaction":"int32", "user":"int32", "block":"int32", "uuid":"int32"}
+NULL = -1 # code of a NULL block or UUID
+
+def require_numpy():
+    if numpy == None:
+        raise RuntimeError("The snapshot engine needs numpy (pip install numpy)")
+
+def export(cursor, dimensions, directory, generation, chunkSize=100000):
+    """Write every dimension (with its partitions) to `directory`. meta.json is written last, a snapshot without it
+    is incomplete. Returns {dimension: rows}"""
+    require_numpy()
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(os.path.join(directory, "meta.json")):
+        os.remove(os.path.join(directory, "meta.json"))
+    codes = {"users":{}, "blocks":{}, "interactions":{}, "uuids":{}} # value: code
+    def encode(dictionary, values):
+        dictionary = codes[dictionary]
+        return numpy.fromiter((NULL if value == None else dictionary.setdefault(value, len(dictionary)) for value in values), "int32", len(values))
+
+    counts = {}
+    for dimension in dimensions:
+        chunks = {column: [] for column in COLUMNS}
+        for (table, number) in database.dimension_sources(cursor, dimension):
+            (source, rowid) = database.read_source(cursor, table)
+            cursor.execute(f"SELECT {database.EVENT_COLUMNS}, {database.partition_row_id(number, rowid)} FROM {source}")
+            while rows := cursor.fetchmany(chunkSize):
+                (x, y, z, interaction, username, lowerUsername, uuid, unixTime, block, rowId) = zip(*rows)
+                for column, values in (("x", x), ("y", y), ("z", z), ("time", unixTime), ("row_id", rowId)):
+                    chunks[column].append(numpy.array(values, COLUMNS[column]))
+                chunks["interaction"].append(encode("interactions", interaction))
+                chunks["user"].append(encode("users", list(zip(username, lowerUsername))))
+                chunks["block"].append(encode("blocks", block))
+                chunks["uuid"].append(encode("uuids", uuid))
+        arrays = {column: numpy.concatenate(chunks[column]) if chunks[column] else numpy.empty(0, COLUMNS[column]) for column in COLUMNS}
+        order = numpy.lexsort((-arrays["row_id"], -arrays["time"])) # newest first, like the SQL ordering
+        os.makedirs(os.path.join(directory, dimension), exist_ok=True)
+        for column, array in arrays.items():
+            numpy.save(os.path.join(directory, dimension, f"{column}.npy"), array[order])
+        counts[dimension] = len(order)
+
+    with open(os.path.join(directory, "meta.json"), "w") as file:
+        json.dump({"generation":generation, "time":round(time.time()), "dimensions":counts,
+            **{name: list(dictionary) for name, dictionary in codes.items()}}, file)
+    return counts
+
+class Snapshot:
+    def __init__(self, directory):
+        require_numpy()
+        with open(os.path.join(directory, "meta.json"), "r") as file:
+            meta = json.load(file)
+        self.generation = meta["generation"]
+        self.users = meta["users"] # [username, lower_username]
+        self.blocks = meta["blocks"]
+        self.interactions = meta["interactions"]
+        self.uuids = meta["uuids"]
+        self.columns = {}
+        for dimension, rows in meta["dimensions"].items():
+            # an empty file can not be memory mapped
+            self.columns[dimension] = {column: numpy.load(os.path.join(directory, dimension, f"{column}.npy"), mmap_mode="r" if rows else None) for column in COLUMNS}
+        self.codes = {
+            "interaction": {interaction: [code] for code, interaction in enumerate(self.interactions)},
+            "block": {block: [code] for code, block in enumerate(self.blocks)},
+            "lower_username": {},
+        }
+        for code, (username, lowerUsername) in enumerate(self.users):
+            self.codes["lower_username"].setdefault(lowerUsername, []).append(code)
+
+    def covers(self, tables, generation):
+        """Can `tables` be read from this snapshot while the database is at ingest generation `generation`"""
+        return generation == self.generation and all(table in self.columns for table in tables)
+
+    def matches(self, dimension, pos, radius, checks, after, before):
+        """Indexes of the rows of `dimension` matching a lookup, newest first"""
+        columns = self.columns[dimension]
+        unixTime = columns["time"]
+        ascending = unixTime[::-1]
+        start = len(unixTime) - int(numpy.searchsorted(ascending, before, "right")) if before != None else 0
+        end = len(unixTime) - int(numpy.searchsorted(ascending, after, "left")) if after != None else len(unixTime)
+        if start >= end:
+            return numpy.empty(0, "int64")
+        (x, y, z) = (columns["x"][start:end], columns["y"][start:end], columns["z"][start:end])
+        (posX, posY, posZ) = map(int, pos)
+        # bounding box first, the exact distance only for the rows inside it (int64, squares of far coordinates overflow int32)
+        indexes = numpy.nonzero((x >= posX - radius) & (x <= posX + radius) & (y >= posY - radius) & (y <= posY + radius)
+            & (z >= posZ - radius) & (z <= posZ + radius))[0]
+        distance = (x[indexes].astype("int64") - posX) ** 2 + (y[indexes].astype("int64") - posY) ** 2 + (z[indexes].astype("int64") - posZ) ** 2
+        indexes = indexes[distance <= radius ** 2] + start
+        column = {"interaction":"interaction", "block":"block", "lower_username":"user"}
+        for (name, value, negative) in checks:
+            values = columns[column[name]][indexes]
+            equal = numpy.isin(values, self.codes[name].get(value, []))
+            # NULL compares as false both ways, like in SQL
+            indexes = indexes[(~equal & (values != NULL)) if negative else equal]
+        return indexes
+
+    def after_key(self, dimension, indexes, key):
+        """The `indexes` of `dimension` that come after the (UNIX_time, dimension, row_id) key of the previous page"""
+        (keyTime, keyDimension, keyRowId) = (int(key[0]), key[1], int(key[2]))
+        times = self.columns[dimension]["time"][indexes]
+        if dimension < keyDimension:
+            return indexes[times <= keyTime]
+        if dimension > keyDimension:
+            return indexes[times < keyTime]
+        return indexes[(times < keyTime) | ((times == keyTime) & (self.columns[dimension]["row_id"][indexes] < keyRowId))]
+
+    def row(self, dimension, index):
+        """Row `index` of `dimension` as (EVENT_COLUMNS, dimension, row_id)"""
+        columns = self.columns[dimension]
+        (username, lowerUsername) = self.users[columns["user"][index]]
+        block = int(columns["block"][index])
+        uuid = int(columns["uuid"][index])
+        return (int(columns["x"][index]), int(columns["y"][index]), int(columns["z"][index]), self.interactions[columns["interaction"][index]],
+            username, lowerUsername, None if uuid == NULL else self.uuids[uuid], int(columns["time"][index]),
+            None if block == NULL else self.blocks[block], dimension, int(columns["row_id"][index]))
+
+    def lookup(self, tables, pos, radius, checks, after=None, before=None, key=None, limit=10, offset=0):
+        """One page of a lookup, newest first like the SQL path: `limit` rows after the first `offset`, or after `key`.
+        `checks` are (column, value, negative) on interaction, block or lower_username. Returns (rows, total of the whole lookup)"""
+        total = 0
+        candidates = []
+        for dimension in tables:
+            indexes = self.matches(dimension, pos, radius, checks, after, before)
+            total += len(indexes)
+            if key != None:
+                indexes = self.after_key(dimension, indexes, key)
+            # every dimension is sorted already, only its first offset + limit rows can end up on the page
+            for index in indexes[:offset + limit].tolist():
+                candidates.append((int(self.columns[dimension]["time"][index]), dimension, int(self.columns[dimension]["row_id"][index]), index))
+        candidates.sort(reverse=True)
+        return ([self.row(dimension, index) for (_, dimension, _, index) in candidates[offset:offset + limit]], total)